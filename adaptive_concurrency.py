@@ -0,0 +1,219 @@
+import json
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+
+# Status codes that mean the service is over capacity or our quota is used up.
+OVERLOAD_CODES = (grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.UNAVAILABLE)
+# Without a fixed latency target, latency up to this many times the usual latency is
+# still fine.
+LATENCY_TOLERANCE = 1.5
+
+
+class AIMDLimiter:
+    """
+    Limits the number of calls in flight and adapts the limit to what the service can
+    take at the moment: the limit grows by about one per limit-many calls whose latency
+    stays within the target (additive increase), and is cut in half on an overload
+    status code or when latency exceeds spike_factor times the target (multiplicative
+    decrease).
+
+    Latency is measured from the start of a call to its first response. The target is
+    latency_target_s, or, if that is not set, LATENCY_TOLERANCE times the smoothed
+    latency of all recent calls, so a lasting change in latency becomes the new normal
+    instead of holding the limit down. With use_latency=False only overload status codes
+    cut the limit and every successful call counts as within target.
+    """
+
+    def __init__(self, name, initial=4, min_limit=1, max_limit=100, latency_target_s=None,
+                 spike_factor=2.0, backoff=0.5, smoothing=0.1, history=100, log=True,
+                 use_latency=True):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target_s = latency_target_s
+        self.spike_factor = spike_factor
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.log = log
+        self.use_latency = use_latency
+        self.in_flight = 0
+        self.baseline_s = None
+        self.last_decrease = 0.0
+        self.counts = {"started": 0, "within_target": 0, "slow": 0, "spikes": 0, "overloaded": 0, "errors": 0}
+        # Recent limit changes: (unix time, old limit, new limit, reason).
+        self.changes = deque(maxlen=history)
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        # Wait for a free slot and return the monotonic time the call may start at.
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            self.counts["started"] += 1
+            return time.monotonic()
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def _set_limit(self, limit, reason):
+        old = int(self.limit)
+        self.limit = min(float(self.max_limit), max(float(self.min_limit), limit))
+        if int(self.limit) != old:
+            self.changes.append((time.time(), old, int(self.limit), reason))
+            if self.log:
+                print(f"{self.name} concurrency {old} -> {int(self.limit)}: {reason}", file=sys.stderr)
+            self.cond.notify_all()
+
+    def _decrease(self, started, reason):
+        # Calls started before the last cut ran under the old limit, so one overload
+        # episode cuts the limit once instead of once per call it affected.
+        if started < self.last_decrease:
+            return
+        self.last_decrease = time.monotonic()
+        self._set_limit(self.limit * self.backoff, reason)
+
+    def _target(self):
+        if self.latency_target_s is not None:
+            return self.latency_target_s
+        if self.baseline_s is not None:
+            return self.baseline_s * LATENCY_TOLERANCE
+        return None
+
+    def seed(self, concurrency):
+        """
+        Start from the concurrency the caller was configured with, e.g. its number of
+        workers, instead of ramping up from the default.
+        """
+        with self.cond:
+            self.max_limit = max(self.max_limit, concurrency)
+            if concurrency > self.limit:
+                self._set_limit(float(concurrency), "configured concurrency")
+
+    def on_latency(self, started, latency_s):
+        with self.cond:
+            target = self._target() if self.use_latency else None
+            if self.baseline_s is None:
+                self.baseline_s = latency_s
+            else:
+                self.baseline_s += self.smoothing * (latency_s - self.baseline_s)
+            if target is not None and latency_s > target * self.spike_factor:
+                self.counts["spikes"] += 1
+                self._decrease(started, f"latency {latency_s:.2f} s, target {target:.2f} s")
+                return
+            if target is not None and latency_s > target:
+                # Slower than usual but not a spike: hold the limit.
+                self.counts["slow"] += 1
+                return
+            self.counts["within_target"] += 1
+            self._set_limit(self.limit + 1 / self.limit, f"latency {latency_s:.2f} s within target")
+
+    def on_error(self, started, code):
+        with self.cond:
+            if code in OVERLOAD_CODES:
+                self.counts["overloaded"] += 1
+                self._decrease(started, code.name)
+            else:
+                self.counts["errors"] += 1
+
+    def metrics(self):
+        with self.cond:
+            return {
+                "name": self.name,
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency_target_s": self._target(),
+                "baseline_latency_s": self.baseline_s,
+                **self.counts,
+                "changes": [
+                    {"time": t, "from": old, "to": new, "reason": reason}
+                    for t, old, new, reason in self.changes
+                ],
+            }
+
+
+# Limiters shared by all recognition and all synthesis calls of this process. The time
+# to the first recognition result depends on how fast audio is uploaded and where in
+# the audio speech starts, not on service load, so recognition is only throttled by
+# overload status codes.
+STT_LIMITER = AIMDLimiter("recognition", use_latency=False)
+TTS_LIMITER = AIMDLimiter("synthesis")
+
+
+def limited_stream(limiter, call):
+    """
+    Run a streaming gRPC call under limiter. call() starts the call and returns its
+    response iterator; the slot is held until the responses are exhausted or the
+    consumer stops reading:
+
+        responses = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(requests))
+    """
+    started = limiter.acquire()
+    try:
+        first = True
+        for response in call():
+            if first:
+                limiter.on_latency(started, time.monotonic() - started)
+                first = False
+            yield response
+        if first:
+            limiter.on_latency(started, time.monotonic() - started)
+    except grpc.RpcError as err:
+        limiter.on_error(started, err.code())
+        raise
+    finally:
+        limiter.release()
+
+
+def limited_call(limiter, call, expected_codes=()):
+    """
+    Run a unary gRPC call under limiter and return its result:
+
+        operation = limited_call(STT_LIMITER, lambda: stub.RecognizeFile(request))
+
+    Errors with expected_codes are part of normal use (e.g. "not ready yet" while
+    polling) and are neither counted nor treated as overload.
+    """
+    started = limiter.acquire()
+    try:
+        result = call()
+        limiter.on_latency(started, time.monotonic() - started)
+        return result
+    except grpc.RpcError as err:
+        if err.code() not in expected_codes:
+            limiter.on_error(started, err.code())
+        raise
+    finally:
+        limiter.release()
+
+
+def metrics():
+    return [STT_LIMITER.metrics(), TTS_LIMITER.metrics()]
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(metrics(), indent=4).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port=9108):
+    # Serve the current limits and recent changes as JSON from a background thread.
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,290 @@
+import argparse
+import itertools
+import os
+import tempfile
+import threading
+import time
+from concurrent import futures
+from pathlib import Path
+
+import grpc
+
+import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
+import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
+
+from adaptive_concurrency import STT_LIMITER, limited_call
+
+try:
+    # Asynchronous file recognition is only available in newer SDK versions.
+    import yandex.cloud.ai.stt.v3.stt_service_pb2 as stt_service_pb2
+    from yandex.cloud.operation import operation_pb2
+    AsyncRecognizerStub = stt_service_pb2_grpc.AsyncRecognizerStub
+except (ImportError, AttributeError):
+    AsyncRecognizerStub = None
+
+# Statuses GetRecognition returns while the operation is still running.
+NOT_READY_CODES = (grpc.StatusCode.NOT_FOUND, grpc.StatusCode.FAILED_PRECONDITION)
+POLL_INITIAL_S = 1.0
+POLL_MAX_S = 30.0
+MAX_IN_FLIGHT = 32
+# An operation that has not finished after this long is given up on.
+COLLECT_TIMEOUT_S = 3 * 3600
+# Files sent as content must fit in one gRPC message, which is limited to 4 MB by
+# default. Larger files are sent as mono MP3 parts of PART_MS (2.4 MB each).
+MAX_CONTENT_BYTES = 3_500_000
+PART_MS = 10 * 60 * 1000
+
+
+def recognition_model(language="he-IL"):
+    return stt_pb2.RecognitionModelOptions(
+        audio_format=stt_pb2.AudioFormatOptions(
+            container_audio=stt_pb2.ContainerAudio(
+                container_audio_type=stt_pb2.ContainerAudio.MP3,
+            )
+        ),
+        text_normalization=stt_pb2.TextNormalizationOptions(
+            text_normalization=stt_pb2.TextNormalizationOptions.TEXT_NORMALIZATION_ENABLED,
+            profanity_filter=False,
+            literature_text=False,
+        ),
+        language_restriction=stt_pb2.LanguageRestrictionOptions(
+            restriction_type=stt_pb2.LanguageRestrictionOptions.WHITELIST,
+            language_code=[language],
+        ),
+    )
+
+
+def create_stub(target="api.speechkit.cloudil.com:443", secure=True):
+    if AsyncRecognizerStub is None:
+        raise RuntimeError(
+            "Asynchronous recognition needs a newer yandexcloud package: pip install -U yandexcloud"
+        )
+    if secure:
+        channel = grpc.secure_channel(target, grpc.ssl_channel_credentials())
+    else:
+        channel = grpc.insecure_channel(target)
+    return AsyncRecognizerStub(channel)
+
+
+def write_transcript(responses, out_file_name):
+    # Same output as transcribing_meeting_zoom.py: "text start end" lines for finals,
+    # followed by the normalized text.
+    with open(out_file_name, "a") as f:
+        for r in responses:
+            event_type = r.WhichOneof("Event")
+            if event_type == "final":
+                for a in r.final.alternatives:
+                    f.write(f"{a.text} {a.start_time_ms} {a.end_time_ms}\n")
+            elif event_type == "final_refinement":
+                alternatives = r.final_refinement.normalized_text.alternatives
+                if len(alternatives) > 0:
+                    f.write(alternatives[0].text)
+
+
+def shift_times(responses, offset_ms):
+    # Times in the results for a part of a file are relative to the start of the part.
+    for r in responses:
+        if r.WhichOneof("Event") == "final":
+            for a in r.final.alternatives:
+                a.start_time_ms += offset_ms
+                a.end_time_ms += offset_ms
+                for w in a.words:
+                    w.start_time_ms += offset_ms
+                    w.end_time_ms += offset_ms
+    return responses
+
+
+class AsyncBatchRecognizer:
+    """
+    Submits whole files to the asynchronous recognition API and keeps up to
+    max_in_flight operations running at the same time. Each operation is polled with
+    exponential backoff, so a large batch costs few requests while it waits. Files
+    larger than MAX_CONTENT_BYTES are split into parts that are recognized separately,
+    and a file is only read when it is submitted.
+    """
+
+    def __init__(self, stub, model, max_in_flight=MAX_IN_FLIGHT, metadata=(),
+                 poll_initial=POLL_INITIAL_S, poll_max=POLL_MAX_S, uri_prefix=None,
+                 collect_timeout=COLLECT_TIMEOUT_S):
+        self.stub = stub
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.metadata = metadata
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.uri_prefix = uri_prefix
+        self.collect_timeout = collect_timeout
+
+    def _submit(self, audio_path):
+        if self.uri_prefix:
+            # Files already uploaded to object storage are referenced, not sent.
+            request = stt_pb2.RecognizeFileRequest(
+                uri=self.uri_prefix.rstrip("/") + "/" + Path(audio_path).name,
+                recognition_model=self.model,
+            )
+        else:
+            request = stt_pb2.RecognizeFileRequest(
+                content=Path(audio_path).read_bytes(), recognition_model=self.model,
+            )
+        return limited_call(STT_LIMITER, lambda: self.stub.RecognizeFile(request, metadata=self.metadata)).id
+
+    def _collect(self, operation_id):
+        delay = self.poll_initial
+        deadline = time.monotonic() + self.collect_timeout
+        while True:
+            request = stt_service_pb2.GetRecognitionRequest(operation_id=operation_id)
+            try:
+                # Read the whole stream before returning, so a "not ready" error that
+                # arrives on the stream is retried instead of producing a partial result.
+                return limited_call(
+                    STT_LIMITER, lambda: list(self.stub.GetRecognition(request, metadata=self.metadata)),
+                    expected_codes=NOT_READY_CODES,
+                )
+            except grpc.RpcError as err:
+                if err.code() not in NOT_READY_CODES:
+                    raise
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Operation {operation_id} did not finish in {self.collect_timeout} s")
+            time.sleep(delay)
+            delay = min(delay * 1.5, self.poll_max)
+
+    def _process(self, audio_path, out_path):
+        started = time.monotonic()
+        with tempfile.TemporaryDirectory() as work_dir:
+            send_path = Path(audio_path)
+            if not self.uri_prefix and send_path.suffix.lower() != ".mp3":
+                # The service accepts MP3, WAV and OGG containers. Converting here runs
+                # in the pool, so other files are submitted meanwhile.
+                from audio_preprocess import transcode_to_mp3
+
+                send_path = Path(work_dir) / (send_path.stem + ".mp3")
+                transcode_to_mp3(audio_path, send_path)
+            if self.uri_prefix or send_path.stat().st_size <= MAX_CONTENT_BYTES:
+                operations = [(self._submit(send_path), 0)]
+            else:
+                # Imported here so that files that fit in one request do not need NumPy.
+                from audio_preprocess import split_to_mp3
+
+                parts = split_to_mp3(send_path, work_dir, PART_MS)
+                operations = [(self._submit(part), offset_ms) for part, offset_ms in parts]
+        responses = []
+        for operation_id, offset_ms in operations:
+            responses.extend(shift_times(self._collect(operation_id), offset_ms))
+        write_transcript(responses, out_path)
+        print(f"Recognized {audio_path} in {time.monotonic() - started:.1f} s")
+
+    def run(self, jobs):
+        """
+        jobs is an iterable of (audio_path, out_path). Returns the list of failed jobs.
+        """
+        failed = []
+        STT_LIMITER.seed(self.max_in_flight)
+        with futures.ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            running = {pool.submit(self._process, a, o): (a, o) for a, o in jobs}
+            for future in futures.as_completed(running):
+                try:
+                    future.result()
+                except grpc.RpcError as err:
+                    print(f"Error code {err.code()}, message: {err.details()}")
+                    failed.append(running[future])
+                except Exception as err:
+                    print(f"{running[future][0]}: {type(err).__name__}: {err}")
+                    failed.append(running[future])
+        return failed
+
+
+class FakeAsyncRecognizer(stt_service_pb2_grpc.AsyncRecognizerServicer if AsyncRecognizerStub else object):
+    """
+    Local stand-in for the asynchronous recognizer. An operation finishes after
+    seconds_per_mb seconds per megabyte of audio and returns one final per 100 KB.
+    """
+
+    def __init__(self, seconds_per_mb=0.5):
+        self.seconds_per_mb = seconds_per_mb
+        self.ids = itertools.count()
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def RecognizeFile(self, request, context):
+        size = len(request.content) if request.content else 1_000_000
+        operation_id = f"fake{next(self.ids)}"
+        with self.lock:
+            self.operations[operation_id] = (time.monotonic() + size / 1e6 * self.seconds_per_mb, size)
+        return operation_pb2.Operation(id=operation_id, done=False)
+
+    def GetRecognition(self, request, context):
+        with self.lock:
+            ready_at, size = self.operations.get(request.operation_id, (None, 0))
+        if ready_at is None or time.monotonic() < ready_at:
+            context.abort(grpc.StatusCode.NOT_FOUND, "Operation is not ready")
+        for i in range(max(1, size // 100_000)):
+            alternative = stt_pb2.Alternative(text=f"phrase {i}", start_time_ms=i * 5000,
+                                              end_time_ms=i * 5000 + 4000)
+            yield stt_pb2.StreamingResponse(final=stt_pb2.AlternativeUpdate(alternatives=[alternative]))
+            normalized = stt_pb2.AlternativeUpdate(alternatives=[stt_pb2.Alternative(text=f"Phrase {i}.")])
+            yield stt_pb2.StreamingResponse(final_refinement=stt_pb2.FinalRefinement(
+                final_index=i, normalized_text=normalized))
+
+
+def serve_fake(port, seconds_per_mb=0.5):
+    # Leave room above MAX_CONTENT_BYTES instead of the 4 MB gRPC default.
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=64),
+                         options=[("grpc.max_receive_message_length", 16 * 1024 * 1024)])
+    stt_service_pb2_grpc.add_AsyncRecognizerServicer_to_server(FakeAsyncRecognizer(seconds_per_mb), server)
+    port = server.add_insecure_port(f"127.0.0.1:{port}")
+    server.start()
+    return server, port
+
+
+def process_directory(input_dir, output_dir, language="he-IL", max_in_flight=MAX_IN_FLIGHT,
+                      target=None, uri_prefix=None, fake=False):
+    input_dir_path = Path(input_dir)
+    output_dir_path = Path(output_dir)
+    if not output_dir_path.is_dir():
+        output_dir_path.mkdir()
+
+    jobs = []
+    for audio_file in sorted(input_dir_path.iterdir()):
+        suffix = audio_file.suffix.lower()
+        if suffix not in (".m4a", ".mp3"):
+            continue
+        if suffix == ".m4a" and uri_prefix:
+            # Referenced files are not converted, and the service does not read m4a.
+            print(f"Skipping {audio_file}: upload it as MP3 to use --uri-prefix")
+            continue
+        jobs.append((audio_file, output_dir_path / (audio_file.stem + ".txt")))
+
+    server = None
+    if fake:
+        server, port = serve_fake(0)
+        stub = create_stub(f"127.0.0.1:{port}", secure=False)
+    elif target:
+        stub = create_stub(target)
+    else:
+        stub = create_stub()
+    metadata = () if fake else (("authorization", f"Api-Key {os.environ['SPEECHKIT_API_KEY']}"),)
+
+    try:
+        recognizer = AsyncBatchRecognizer(stub, recognition_model(language), max_in_flight,
+                                          metadata=metadata, uri_prefix=uri_prefix)
+        failed = recognizer.run(jobs)
+    finally:
+        if server is not None:
+            server.stop(None)
+    if failed:
+        print(f"{len(failed)} files failed: {', '.join(str(a) for a, _ in failed)}")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--language", default="he-IL")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument("--uri-prefix", default=None)  # e.g. https://storage.example.com/bucket/recordings
+    parser.add_argument("--target", default=None)  # host:port of the recognizer
+    parser.add_argument("--fake", action="store_true")  # Use a local stand-in instead of the service
+    args = parser.parse_args()
+    process_directory(args.input_dir, args.output_dir, args.language, args.max_in_flight,
+                      args.target, args.uri_prefix, args.fake)
@@ -0,0 +1,397 @@
+import argparse
+import itertools
+import json
+import subprocess
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+
+# Sample rate the recognizer works with internally. 8000 is enough for telephony audio.
+TARGET_RATE = 16000
+# Seconds of audio decoded and sent per request.
+BLOCK_SECONDS = 0.1
+# Length of the anti-aliasing filter used when downsampling.
+NUM_TAPS = 63
+# Bit rate of files re-encoded for a requested sample rate. Raw LINEAR16 at 16 kHz is
+# 256 kbit/s, more than the 128 kbit/s stereo MP3 ffmpeg writes by default, and speech
+# needs far less.
+MP3_BITRATE = "32k"
+
+
+def _mp3_options(sample_rate=None, bitrate=MP3_BITRATE):
+    # Without a sample rate the source rate, channels and ffmpeg's default quality are kept.
+    if sample_rate is None:
+        return ["-codec:a", "libmp3lame"]
+    return ["-ac", "1", "-ar", str(sample_rate), "-codec:a", "libmp3lame", "-b:a", bitrate]
+
+
+def downmix(samples, channels):
+    """
+    Average interleaved int16 (or float) samples of all channels into one mono channel.
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    if channels == 1:
+        return samples
+    return samples.reshape(-1, channels).mean(axis=1)
+
+
+def lowpass_taps(src_rate, dst_rate, num_taps=NUM_TAPS):
+    # Windowed-sinc low-pass filter with the cutoff just below the new Nyquist frequency.
+    cutoff = 0.45 * dst_rate / src_rate
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(num_taps)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+def to_linear16(samples):
+    """
+    Convert float samples in the int16 range to LINEAR16 (16-bit signed little-endian) bytes.
+    """
+    return np.clip(np.rint(samples), -32768, 32767).astype("<i2").tobytes()
+
+
+class Resampler:
+    """
+    Streaming downmix and resample of int16 PCM. Feed blocks of any size with
+    process() and call flush() at the end; output sample j always corresponds to input
+    time j / dst_rate, so timestamps stay exact across block boundaries.
+    """
+
+    def __init__(self, src_rate, dst_rate=TARGET_RATE, channels=1):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.channels = channels
+        self.step = src_rate / dst_rate
+        if dst_rate < src_rate:
+            self.taps = lowpass_taps(src_rate, dst_rate)
+        else:
+            self.taps = np.ones(1, dtype=np.float32)
+        # The filter delays the signal by half its length; output positions are shifted
+        # by the same amount to compensate.
+        self.delay = (len(self.taps) - 1) // 2
+        self.history = np.zeros(len(self.taps) - 1, dtype=np.float32)
+        # Filtered samples not yet consumed, and the absolute index of buf[0].
+        self.buf = np.zeros(0, dtype=np.float32)
+        self.buf_start = 0
+        self.out_count = 0
+
+    def _emit(self):
+        last = self.buf_start + len(self.buf) - 1
+        first_pos = self.delay + self.out_count * self.step
+        if last < first_pos:
+            return np.zeros(0, dtype=np.float32)
+        n = int((last - first_pos) // self.step) + 1
+        positions = self.delay + (self.out_count + np.arange(n)) * self.step - self.buf_start
+        self.out_count += n
+        out = np.interp(positions, np.arange(len(self.buf)), self.buf).astype(np.float32)
+        # Keep the samples still needed to interpolate the next output position.
+        keep_from = int(self.delay + self.out_count * self.step) - self.buf_start
+        keep_from = max(0, min(keep_from, len(self.buf) - 1))
+        self.buf = self.buf[keep_from:]
+        self.buf_start += keep_from
+        return out
+
+    def process(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(data, dtype="<i2")
+        mono = downmix(data, self.channels)
+        if self.src_rate == self.dst_rate:
+            return mono
+        signal = np.concatenate([self.history, mono])
+        filtered = np.convolve(signal, self.taps, mode="valid")
+        self.history = signal[len(signal) - len(self.history):] if len(self.history) else self.history
+        self.buf = np.concatenate([self.buf, filtered.astype(np.float32)])
+        return self._emit()
+
+    def flush(self):
+        if self.src_rate == self.dst_rate:
+            return np.zeros(0, dtype=np.float32)
+        # Push zeros through the filter so the delayed tail of the signal comes out.
+        tail = np.zeros(self.delay * self.channels + self.channels, dtype=np.float32)
+        return self.process(tail)
+
+
+def probe_audio(path):
+    """
+    Return (sample_rate, channels) of the first audio stream, read from the headers.
+    """
+    out = subprocess.check_output([
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=sample_rate,channels",
+        "-of", "json", str(path),
+    ])
+    stream = json.loads(out)["streams"][0]
+    return int(stream["sample_rate"]), int(stream["channels"])
+
+
+def _iter_wav_blocks(path, block_seconds):
+    # 16-bit PCM WAV files are read directly, without starting ffmpeg.
+    with wave.open(str(path), "rb") as w:
+        if w.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit WAV files are supported")
+        rate, channels = w.getframerate(), w.getnchannels()
+        frames = max(1, int(rate * block_seconds))
+        data = w.readframes(frames)
+        while data:
+            yield np.frombuffer(data, dtype="<i2"), rate, channels
+            data = w.readframes(frames)
+
+
+def iter_decoded_blocks(path, block_seconds=BLOCK_SECONDS):
+    """
+    Decode a file with ffmpeg at its native rate and channel count and yield
+    (int16 samples, sample_rate, channels) blocks.
+    """
+    if Path(path).suffix.lower() == ".wav":
+        yield from _iter_wav_blocks(path, block_seconds)
+        return
+
+    rate, channels = probe_audio(path)
+    block_bytes = int(rate * block_seconds) * channels * 2
+    proc = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-i", str(path), "-f", "s16le", "-acodec", "pcm_s16le", "-"],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        while True:
+            data = proc.stdout.read(block_bytes)
+            if not data:
+                break
+            # A short read can split a frame; keep whole frames only.
+            data = data[:len(data) - len(data) % (2 * channels)]
+            yield np.frombuffer(data, dtype="<i2"), rate, channels
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+class PcmWindow:
+    """
+    A fixed-duration piece of decoded audio: interleaved LINEAR16 data starting
+    offset_frames samples (offset_ms milliseconds) into the recording.
+    """
+
+    __slots__ = ("index", "offset_frames", "data", "sample_rate", "channels")
+
+    def __init__(self, index, offset_frames, data, sample_rate, channels):
+        self.index = index
+        self.offset_frames = offset_frames
+        self.data = data
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    @property
+    def offset_ms(self):
+        return self.offset_frames * 1000 // self.sample_rate
+
+    @property
+    def duration_ms(self):
+        return len(self.data) // (2 * self.channels) * 1000 // self.sample_rate
+
+
+def iter_pcm_windows(path, window_ms, sample_rate=None, channels=1, start_ms=0,
+                     allow_truncated=False):
+    """
+    Decode any file ffmpeg can read sequentially through a pipe and yield PcmWindow
+    objects of window_ms each (the last one can be shorter). Only one window is held
+    in memory, however long the recording is. Offsets are counted in samples, so they
+    are exact. Without sample_rate the native rate of the file is kept. With start_ms
+    decoding starts at that position and offsets are still relative to the file start.
+
+    A decoding error raises RuntimeError after the windows decoded so far, so a damaged
+    file is not mistaken for a short one. A file that is still being written usually
+    ends in a cut-off frame; with allow_truncated=True such an error only raises if
+    nothing could be decoded.
+    """
+    if sample_rate is None:
+        sample_rate, _ = probe_audio(path)
+    frame_bytes = 2 * channels
+    window_bytes = round(sample_rate * window_ms / 1000) * frame_bytes
+    seek = ["-ss", f"{start_ms / 1000:.3f}"] if start_ms else []
+    proc = subprocess.Popen(
+        ["ffmpeg", "-v", "error", *seek, "-i", str(path), "-vn", "-ac", str(channels),
+         "-ar", str(sample_rate), "-f", "s16le", "-acodec", "pcm_s16le", "-"],
+        stdout=subprocess.PIPE,
+    )
+    offset_frames = round(start_ms * sample_rate / 1000)
+    start_frames = offset_frames
+    try:
+        for index in itertools.count():
+            # read() on the pipe blocks until the whole window arrived or ffmpeg finished.
+            data = proc.stdout.read(window_bytes)
+            data = data[:len(data) - len(data) % frame_bytes]
+            if not data:
+                break
+            yield PcmWindow(index, offset_frames, data, sample_rate, channels)
+            offset_frames += len(data) // frame_bytes
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0 and (not allow_truncated or offset_frames == start_frames):
+        raise RuntimeError(f"ffmpeg could not decode {path}")
+
+
+def write_mp3(window, out_path, sample_rate=None):
+    """
+    Encode a PcmWindow to an MP3 file; with sample_rate, as mono at that rate and
+    MP3_BITRATE.
+    """
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "s16le", "-ar", str(window.sample_rate),
+         "-ac", str(window.channels), "-i", "-", *_mp3_options(sample_rate), str(out_path)],
+        input=window.data, check=True,
+    )
+
+
+def transcode_to_mp3(src_path, dst_path, sample_rate=None):
+    """
+    Convert any audio or video file to MP3 with ffmpeg, which streams the file instead
+    of loading it into memory. With sample_rate the MP3 is mono at that rate and
+    MP3_BITRATE.
+    """
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-i", str(src_path), "-vn", *_mp3_options(sample_rate),
+         str(dst_path)],
+        check=True,
+    )
+
+
+def split_to_mp3(src_path, out_dir, part_ms):
+    """
+    Convert any audio or video file to mono 16 kHz MP3 parts of about part_ms each in
+    out_dir, in a single ffmpeg run. Returns a list of (part path, offset in ms), with
+    the offsets ffmpeg reports for where each part starts.
+    """
+    out_dir = Path(out_dir)
+    parts_list = out_dir / f"{Path(src_path).stem}_parts.csv"
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-i", str(src_path), "-vn", *_mp3_options(TARGET_RATE),
+         "-f", "segment", "-segment_time", f"{part_ms / 1000:.3f}",
+         "-segment_list", str(parts_list), "-segment_list_type", "csv",
+         str(out_dir / f"{Path(src_path).stem}_part%03d.mp3")],
+        check=True,
+    )
+    parts = []
+    for line in parts_list.read_text().splitlines():
+        name, start, _ = line.rsplit(",", 2)
+        parts.append((out_dir / name, round(float(start) * 1000)))
+    parts_list.unlink()
+    return parts
+
+
+def iter_mp3_file(path, sample_rate=TARGET_RATE, bitrate=MP3_BITRATE, chunk_size=4000):
+    """
+    Encode any file ffmpeg can read to mono MP3 at sample_rate while it is being sent,
+    and yield the encoded bytes in chunks of chunk_size.
+    """
+    proc = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-i", str(path), "-vn", *_mp3_options(sample_rate, bitrate),
+         "-f", "mp3", "-"],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        for data in iter(lambda: proc.stdout.read(chunk_size), b""):
+            yield data
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg could not encode {path}")
+
+
+def iter_linear16_file(path, dst_rate=TARGET_RATE, block_seconds=BLOCK_SECONDS):
+    """
+    Yield LINEAR16 mono chunks at dst_rate for any file ffmpeg can read.
+    """
+    resampler = None
+    for samples, rate, channels in iter_decoded_blocks(path, block_seconds):
+        if resampler is None:
+            resampler = Resampler(rate, dst_rate, channels)
+        out = resampler.process(samples)
+        if len(out):
+            yield to_linear16(out)
+    if resampler is not None:
+        out = resampler.flush()
+        if len(out):
+            yield to_linear16(out)
+
+
+def _cpu_seconds():
+    try:
+        # Includes the CPU time of ffmpeg; only available on POSIX systems.
+        import resource
+    except ImportError:
+        return time.process_time()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def benchmark(path=None, dst_rate=TARGET_RATE, src_rate=44100, channels=1, seconds=60):
+    """
+    Compare bytes on the wire and client CPU time of the current setup (sending the file
+    as is, or 44.1 kHz PCM from the microphone) with what the scripts send instead: mono
+    MP3 at dst_rate for files, LINEAR16 mono at dst_rate for the microphone.
+    """
+    results = {}
+    if path is not None:
+        start = _cpu_seconds()
+        with open(path, "rb") as f:
+            sent = sum(len(chunk) for chunk in iter(lambda: f.read(4000), b""))
+        results["file_as_is"] = {"bytes": sent, "cpu_s": round(_cpu_seconds() - start, 3)}
+
+        start = _cpu_seconds()
+        sent = sum(len(chunk) for chunk in iter_mp3_file(path, dst_rate))
+        results[f"mp3_{dst_rate}_{MP3_BITRATE}"] = {"bytes": sent, "cpu_s": round(_cpu_seconds() - start, 3)}
+
+        start = _cpu_seconds()
+        sent = sum(len(chunk) for chunk in iter_linear16_file(path, dst_rate))
+        results[f"linear16_{dst_rate}"] = {"bytes": sent, "cpu_s": round(_cpu_seconds() - start, 3)}
+    else:
+        # Synthetic microphone input: speech-band tones plus noise.
+        t = np.arange(int(src_rate * seconds)) / src_rate
+        signal = 8000 * np.sin(2 * np.pi * 220 * t) + 2000 * np.random.randn(len(t))
+        pcm = np.repeat(signal[:, None], channels, axis=1).astype("<i2").ravel()
+        block = int(src_rate * BLOCK_SECONDS) * channels
+
+        results[f"pcm_{src_rate}_{channels}ch"] = {"bytes": pcm.nbytes, "cpu_s": 0.0}
+
+        start = _cpu_seconds()
+        resampler = Resampler(src_rate, dst_rate, channels)
+        sent = 0
+        for i in range(0, len(pcm), block):
+            sent += len(to_linear16(resampler.process(pcm[i:i + block])))
+        sent += len(to_linear16(resampler.flush()))
+        cpu = _cpu_seconds() - start
+        results[f"linear16_{dst_rate}"] = {
+            "bytes": sent,
+            "cpu_s": round(cpu, 3),
+            "realtime_factor": round(cpu / seconds, 5),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert")
+    convert_parser.add_argument("path")
+    convert_parser.add_argument("--out", default=None)
+    convert_parser.add_argument("--rate", type=int, default=TARGET_RATE)
+
+    bench_parser = subparsers.add_parser("bench")
+    bench_parser.add_argument("path", nargs="?", default=None)
+    bench_parser.add_argument("--rate", type=int, default=TARGET_RATE)
+    bench_parser.add_argument("--seconds", type=int, default=60)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        out_path = Path(args.out or Path(args.path).with_suffix(f".{args.rate}.pcm"))
+        with open(out_path, "wb") as f:
+            for chunk in iter_linear16_file(args.path, args.rate):
+                f.write(chunk)
+    else:
+        print(json.dumps(benchmark(args.path, args.rate, seconds=args.seconds), indent=4))
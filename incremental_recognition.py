@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
+
+from audio_preprocess import TARGET_RATE, iter_pcm_windows
+from recognition import create_stub, recognize_stream, streaming_options
+
+# Audio sent per request.
+BLOCK_MS = 100
+# Finals ending closer than this to the end of the available audio may have been cut
+# off by the end of the stream. They are recognized again on the next run.
+GUARD_MS = 2000
+# The next run starts where the last final ended by its timestamps, but its last word can
+# reach a little further. A first final starting this close to that point that repeats
+# the end of the last final is dropped.
+BOUNDARY_MS = 500
+
+
+class IncrementalState:
+    """
+    Progress of an incremental transcript, kept next to it in <out_path>.state.json:
+    the position up to which the transcript is final, the last stable final, and the
+    size of the recording when it was last read.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.position_ms = 0
+        self.last_final = None
+        self.source_size = -1
+        if self.path.is_file():
+            state = json.loads(self.path.read_text())
+            self.position_ms = state["position_ms"]
+            self.last_final = state["last_final"]
+            self.source_size = state["source_size"]
+
+    def save(self):
+        # Write to a temporary file and rename, so a crash never leaves a broken state.
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({
+            "position_ms": self.position_ms,
+            "last_final": self.last_final,
+            "source_size": self.source_size,
+        }))
+        os.replace(tmp, self.path)
+
+
+def repeats_last_final(segment, last_final, tolerance_ms=BOUNDARY_MS):
+    return (last_final is not None and segment.text != ""
+            and segment.start_ms < last_final["end_ms"] + tolerance_ms
+            and last_final["text"].endswith(segment.text))
+
+
+def recognize_increment(audio_file_name, out_file_name, language="en-US", stub=None,
+                        guard_ms=GUARD_MS, final=False, with_times=True):
+    """
+    Recognize only the part of audio_file_name that has not been transcribed yet and
+    append it to out_file_name as "text start end" lines with offsets from the start
+    of the recording, or, with with_times=False, as the normalized text alone like
+    recognize_audio.py writes it. With final=True the recording is complete and the
+    tail after the last stable final is committed as well. Returns the number of
+    finals appended.
+    """
+    state = IncrementalState(f"{out_file_name}.state.json")
+    size = Path(audio_file_name).stat().st_size
+    if size == state.source_size and not final:
+        return 0
+
+    # Track how much audio was available in this run.
+    available = {"end_ms": state.position_ms}
+
+    def chunks():
+        for window in iter_pcm_windows(audio_file_name, BLOCK_MS, TARGET_RATE, start_ms=state.position_ms,
+                                       allow_truncated=True):
+            available["end_ms"] = window.offset_ms + window.duration_ms
+            yield window.data
+
+    options = streaming_options(
+        "pcm", language, sample_rate=TARGET_RATE,
+        processing=stt_pb2.RecognitionModelOptions.FULL_DATA,
+    )
+    segments = []
+    for segment in recognize_stream(chunks(), options, stub=stub):
+        segment.start_ms += state.position_ms
+        segment.end_ms += state.position_ms
+        segments.append(segment)
+
+    # Only finals that ended well before the end of the available audio are stable.
+    stable_until = available["end_ms"] if final else available["end_ms"] - guard_ms
+    if segments and repeats_last_final(segments[0], state.last_final):
+        segments.pop(0)
+    appended = 0
+    with open(out_file_name, "a") as f:
+        for segment in segments:
+            if segment.end_ms > stable_until:
+                break
+            if with_times:
+                f.write(f"{segment.text} {segment.start_ms} {segment.end_ms}\n")
+            else:
+                f.write(segment.text)
+            state.position_ms = segment.end_ms
+            state.last_final = {"text": segment.text, "start_ms": segment.start_ms,
+                                "end_ms": segment.end_ms}
+            appended += 1
+    if appended == len(segments):
+        # No speech runs past the stable part, so silence up to it need not be sent again.
+        state.position_ms = max(state.position_ms, stable_until)
+    state.source_size = size
+    state.save()
+    return appended
+
+
+def follow(audio_file_name, out_file_name, every_s=60, language="en-US"):
+    # Refresh the transcript of a growing recording every every_s seconds until it
+    # stops growing, then commit the tail.
+    stub = create_stub()
+    last_size = -1
+    while True:
+        size = Path(audio_file_name).stat().st_size
+        finished = size == last_size
+        appended = recognize_increment(audio_file_name, out_file_name, language, stub=stub, final=finished)
+        print(f"Appended {appended} lines to {out_file_name}")
+        if finished:
+            return
+        last_size = size
+        time.sleep(every_s)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("out_path")
+    parser.add_argument("--language", default="en-US")
+    parser.add_argument("--every", type=float, default=None)  # Keep refreshing every N seconds
+    parser.add_argument("--final", action="store_true")  # The recording is complete
+    args = parser.parse_args()
+    if args.every:
+        follow(args.path, args.out_path, args.every, args.language)
+    else:
+        recognize_increment(args.path, args.out_path, args.language, final=args.final)
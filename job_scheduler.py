@@ -0,0 +1,323 @@
+import argparse
+import fnmatch
+import heapq
+import itertools
+import json
+import struct
+import subprocess
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from adaptive_concurrency import STT_LIMITER
+
+# MP4-family containers (m4a, mp4, mov) store the duration in the "mvhd" box.
+MP4_SUFFIXES = {".m4a", ".mp4", ".mov", ".m4v"}
+
+
+def _iter_mp4_boxes(f, start, end):
+    # Walk boxes between start and end, yielding (type, payload_start, payload_end).
+    # Payloads are skipped with seek, so the "mdat" box with the audio is never read.
+    pos = start
+    while end is None or pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            # The box extends to the end of the file.
+            f.seek(0, 2)
+            size = f.tell() - pos
+        if size < header_size:
+            return
+        yield box_type, pos + header_size, pos + size
+        pos += size
+
+
+def _probe_mp4_duration(path):
+    with open(path, "rb") as f:
+        for box_type, payload_start, payload_end in _iter_mp4_boxes(f, 0, None):
+            if box_type != b"moov":
+                continue
+            for child_type, child_start, _ in _iter_mp4_boxes(f, payload_start, payload_end):
+                if child_type != b"mvhd":
+                    continue
+                f.seek(child_start)
+                version = f.read(1)[0]
+                f.read(3)  # flags
+                if version == 1:
+                    _, _, timescale, duration = struct.unpack(">QQIQ", f.read(28))
+                else:
+                    _, _, timescale, duration = struct.unpack(">IIII", f.read(16))
+                if timescale:
+                    return duration / timescale
+    return None
+
+
+def _probe_wav_duration(path):
+    with wave.open(str(path), "rb") as w:
+        return w.getnframes() / w.getframerate()
+
+
+def _probe_ffprobe_duration(path):
+    # ffprobe reads the container headers (or estimates from the bitrate for MP3)
+    # without decoding the audio stream.
+    out = subprocess.check_output([
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(path),
+    ])
+    return float(out.strip())
+
+
+def probe_duration(path):
+    """
+    Return the duration of a recording in seconds, reading only container headers.
+    """
+    suffix = Path(path).suffix.lower()
+    duration = None
+    try:
+        if suffix in MP4_SUFFIXES:
+            duration = _probe_mp4_duration(path)
+        elif suffix == ".wav":
+            duration = _probe_wav_duration(path)
+    except (OSError, struct.error, wave.Error, IndexError):
+        duration = None
+    if duration is None:
+        duration = _probe_ffprobe_duration(path)
+    return duration
+
+
+class TokenBucket:
+    """
+    Token bucket for audio seconds: refills at rate_per_minute / 60 tokens per second
+    up to capacity. A request larger than the capacity waits for a full bucket and
+    then leaves the bucket in debt, so it never blocks forever.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount):
+        needed = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Job:
+    __slots__ = ("path", "duration", "priority", "seq")
+
+    def __init__(self, path, duration, priority=0, seq=0):
+        self.path = path
+        self.duration = duration
+        self.priority = priority
+        self.seq = seq
+
+    def sort_key(self, policy):
+        # heapq pops the smallest key first.
+        if policy == "longest":
+            return (-self.duration, self.seq)
+        if policy == "priority":
+            return (-self.priority, -self.duration, self.seq)
+        return (self.seq,)
+
+
+class JobScheduler:
+    """
+    Orders recordings by a policy and runs them with a bounded number of concurrent
+    recognition sessions and an audio-seconds-per-minute budget.
+
+    Policies: "longest" (longest first, shortens the makespan), "priority"
+    (higher priority first, longest first within a priority) and "fifo".
+    """
+
+    POLICIES = ("longest", "priority", "fifo")
+
+    def __init__(self, max_sessions=4, audio_seconds_per_minute=None, policy="longest"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy {policy}, expected one of {self.POLICIES}")
+        self.max_sessions = max_sessions
+        self.policy = policy
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.bucket = TokenBucket(audio_seconds_per_minute) if audio_seconds_per_minute else None
+        self.lock = threading.Lock()
+        self.heap = []
+        self.seq = itertools.count()
+        self.total_seconds = 0.0
+        self.running = {}
+        self.done_seconds = 0.0
+        self.started_at = None
+
+    def add(self, path, priority=0, duration=None):
+        if duration is None:
+            duration = probe_duration(path)
+        job = Job(path, duration, priority, next(self.seq))
+        with self.lock:
+            heapq.heappush(self.heap, (job.sort_key(self.policy), job.seq, job))
+            self.total_seconds += duration
+        return job
+
+    def _pop(self):
+        with self.lock:
+            if not self.heap:
+                return None
+            job = heapq.heappop(self.heap)[2]
+            self.running[job.seq] = job
+            return job
+
+    @contextmanager
+    def session(self, audio_seconds):
+        """
+        Hold one recognition session slot and charge audio_seconds to the rate budget.
+        """
+        if self.bucket is not None:
+            self.bucket.acquire(audio_seconds)
+        with self.sessions:
+            yield
+        with self.lock:
+            self.done_seconds += audio_seconds
+
+    def status(self):
+        with self.lock:
+            remaining = max(0.0, self.total_seconds - self.done_seconds)
+            elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+            throughput = self.done_seconds / elapsed if elapsed > 0 and self.done_seconds else None
+            if self.bucket is not None:
+                limit = self.bucket.rate
+                throughput = min(throughput, limit) if throughput else limit
+            eta = remaining / throughput if throughput else None
+            return {
+                "queued": len(self.heap),
+                "running": len(self.running),
+                "remaining_audio_s": round(remaining, 1),
+                "audio_s_per_s": round(throughput, 2) if throughput else None,
+                "eta_s": round(eta, 1) if eta is not None else None,
+            }
+
+    def _worker(self, handler):
+        while True:
+            job = self._pop()
+            if job is None:
+                return
+            try:
+                handler(job, self)
+            finally:
+                with self.lock:
+                    self.running.pop(job.seq, None)
+                print(f"Finished {job.path}: {json.dumps(self.status())}")
+
+    def run(self, handler, report_interval=30):
+        """
+        Call handler(job, scheduler) for every queued job. The handler wraps each
+        recognition call in scheduler.session(seconds).
+        """
+        self.started_at = time.monotonic()
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(report_interval):
+                print(f"Scheduler status: {json.dumps(self.status())}")
+
+        reporter = threading.Thread(target=report, daemon=True)
+        reporter.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_sessions) as pool:
+                workers = [pool.submit(self._worker, handler) for _ in range(self.max_sessions)]
+                for w in workers:
+                    w.result()
+        finally:
+            stop.set()
+
+
+def load_priorities(path):
+    """
+    Read "<glob> <priority>" lines, e.g. "board-*.m4a 10", into a list of (pattern,
+    priority). Empty lines and lines starting with # are skipped.
+    """
+    rules = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            pattern, priority = line.rsplit(None, 1)
+            rules.append((pattern.strip(), int(priority)))
+    return rules
+
+
+def priority_for(path, rules):
+    # The first pattern that matches the file name wins; other files get priority 0.
+    for pattern, priority in rules:
+        if fnmatch.fnmatch(Path(path).name, pattern):
+            return priority
+    return 0
+
+
+def process_directory(input_dir, output_dir, max_sessions=4, audio_seconds_per_minute=None,
+                      policy="longest", priorities=()):
+    # Imported here so the scheduler itself does not require the SpeechKit SDK.
+    from transcribing_meeting_zoom import CHUNK_LENGTH_MS, chunk_audio, recognize_audio
+
+    input_dir_path = Path(input_dir)
+    output_dir_path = Path(output_dir)
+    if not output_dir_path.is_dir():
+        output_dir_path.mkdir()
+
+    scheduler = JobScheduler(max_sessions, audio_seconds_per_minute, policy)
+    STT_LIMITER.seed(max_sessions)
+    for audio_file in input_dir_path.glob("*.m4a"):
+        job = scheduler.add(audio_file, priority_for(audio_file, priorities))
+        print(f"Queued {audio_file} ({job.duration:.1f} s, priority {job.priority})")
+
+    def handle(job, scheduler):
+        txt_file = output_dir_path / (job.path.stem + ".txt")
+
+        # Chunks of one recording are recognized in order, so the transcript stays ordered.
+        # They are written next to the transcripts, as by transcribing_meeting_zoom.py.
+        remaining = job.duration
+        for chunk_file, offset_ms in chunk_audio(job.path, output_dir_path):
+            chunk_seconds = min(CHUNK_LENGTH_MS / 1000, remaining)
+            remaining -= chunk_seconds
+            with scheduler.session(chunk_seconds):
+                recognize_audio(chunk_file, txt_file, offset_ms=offset_ms, quiet=True)
+
+    scheduler.run(handle)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--max-sessions", type=int, default=4)
+    parser.add_argument("--audio-seconds-per-minute", type=float, default=None)
+    parser.add_argument("--policy", choices=JobScheduler.POLICIES, default="longest")
+    parser.add_argument("--priorities", default=None)  # File with "<glob> <priority>" lines
+    args = parser.parse_args()
+    if args.policy == "priority" and args.priorities is None:
+        parser.error("--policy priority needs --priorities")
+    priorities = load_priorities(args.priorities) if args.priorities else ()
+    process_directory(args.input_dir, args.output_dir, args.max_sessions,
+                      args.audio_seconds_per_minute, args.policy, priorities)
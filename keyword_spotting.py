@@ -0,0 +1,271 @@
+import argparse
+import json
+import sys
+from array import array
+
+
+def normalize(text):
+    # Lowercase without changing the length, so positions in the normalized text are
+    # positions in the original text.
+    lower = text.lower()
+    if len(lower) == len(text):
+        return lower
+    return "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+
+def _common_prefix(a, b):
+    # Length of the common prefix, with string comparisons done in C.
+    if a.startswith(b):
+        return len(b)
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over a watchlist of terms. It is built once, in time linear
+    in the total length of the terms, and finds all of them in one pass over a text,
+    however many terms there are. Matching is case-insensitive.
+    """
+
+    def __init__(self, terms):
+        self.terms = []
+        goto = [{}]
+        term_at = [-1]
+        for term in terms:
+            key = " ".join(normalize(term).split())
+            if not key:
+                continue
+            state = 0
+            for ch in key:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    term_at.append(-1)
+                state = nxt
+            if term_at[state] < 0:
+                term_at[state] = len(self.terms)
+                self.terms.append(term)
+
+        # Breadth-first: failure links, and output links to the nearest shorter suffix
+        # that is a whole term.
+        fail = array("i", [0]) * len(goto)
+        output = array("i", [0]) * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, nxt in goto[state].items():
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                target = goto[f].get(ch, 0)
+                fail[nxt] = target if target != nxt else 0
+                output[nxt] = fail[nxt] if term_at[fail[nxt]] >= 0 else output[fail[nxt]]
+                queue.append(nxt)
+        self.goto = goto
+        self.fail = fail
+        self.output = output
+        self.term_at = array("i", term_at)
+        self.lengths = array("i", (len(" ".join(normalize(t).split())) for t in self.terms))
+
+    def step(self, state, ch):
+        goto, fail = self.goto, self.fail
+        while state and ch not in goto[state]:
+            state = fail[state]
+        return goto[state].get(ch, 0)
+
+    def matches(self, state):
+        # Indexes of all terms that end at a position where the automaton is in state.
+        if self.term_at[state] < 0:
+            state = self.output[state]
+        while state:
+            yield self.term_at[state]
+            state = self.output[state]
+
+
+class KeywordHit:
+    __slots__ = ("term", "start_ms", "end_ms", "channel", "is_final", "text")
+
+    def __init__(self, term, start_ms, end_ms, channel, is_final, text):
+        self.term = term
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.channel = channel
+        self.is_final = is_final
+        self.text = text
+
+    def to_json(self):
+        return {"term": self.term, "start_ms": self.start_ms, "end_ms": self.end_ms,
+                "channel": self.channel, "final": self.is_final}
+
+
+class _Utterance:
+    # Scan progress through the current utterance of one channel.
+    __slots__ = ("text", "states", "confirmed", "emitted")
+
+    def __init__(self):
+        self.text = ""
+        # Automaton state after every character of text.
+        self.states = array("i")
+        # (end position, term index) of matches whose word boundaries were checked.
+        self.confirmed = []
+        # Matches already reported from partials.
+        self.emitted = set()
+
+
+def _is_boundary(text, pos):
+    return pos < 0 or pos >= len(text) or not text[pos].isalnum()
+
+
+class KeywordSpotter:
+    """
+    Applies a KeywordAutomaton to live recognition results. A partial usually repeats
+    the previous partial of the same utterance with a few more words, so only the text
+    after the part both have in common is scanned; the cost of an event depends on how
+    much text changed, not on its length or the size of the watchlist.
+
+    Hits are passed to sink as KeywordHit objects: from partials as soon as the word
+    after the term has arrived (is_final=False, reported once per utterance), and once
+    more for every term in the final text (is_final=True). Terms only match whole words.
+    """
+
+    def __init__(self, automaton, sink):
+        self.automaton = automaton
+        self.sink = sink
+        self.utterances = {}
+
+    def _scan(self, utt, text):
+        automaton = self.automaton
+        norm = normalize(text)
+        # Keep the progress for the part that did not change.
+        keep = _common_prefix(norm, utt.text)
+        del utt.states[keep:]
+        # A match ending right before the change was confirmed by a character that may
+        # have changed, so it is checked again.
+        while utt.confirmed and utt.confirmed[-1][0] >= keep - 1:
+            utt.confirmed.pop()
+
+        state = utt.states[-1] if utt.states else 0
+        new = len(utt.confirmed)
+        for i in range(keep, len(norm)):
+            if i > 0:
+                self._confirm(utt, norm, i - 1, utt.states[i - 1])
+            state = automaton.step(state, norm[i])
+            utt.states.append(state)
+        utt.text = norm
+        return new
+
+    def _confirm(self, utt, norm, end, state):
+        if not _is_boundary(norm, end + 1):
+            return
+        for term in self.automaton.matches(state):
+            if _is_boundary(norm, end - self.automaton.lengths[term]):
+                utt.confirmed.append((end, term))
+
+    def _hit(self, term, end, text, channel, is_final, start_ms, end_ms, words):
+        first = end - self.automaton.lengths[term] + 1
+        if words:
+            # Time of the words the term spans.
+            spans, pos = [], 0
+            for word in words:
+                found = text.find(word.text, pos) if word.text else -1
+                if found < 0:
+                    continue
+                spans.append((found, found + len(word.text) - 1, word.start_ms, word.end_ms))
+                pos = found + len(word.text)
+            inside = [s for s in spans if s[1] >= first and s[0] <= end]
+            if inside:
+                start_ms, end_ms = inside[0][2], inside[-1][3]
+        matched = text[first:end + 1]
+        return KeywordHit(self.automaton.terms[term], start_ms, end_ms, channel, is_final, matched)
+
+    def feed(self, text, is_final, channel="", start_ms=0, end_ms=0, words=()):
+        """
+        Process the text of one partial or final event. words is an optional sequence of
+        objects with text, start_ms and end_ms for word-level hit times.
+        """
+        utt = self.utterances.get(channel)
+        if utt is None:
+            utt = self.utterances[channel] = _Utterance()
+        new = self._scan(utt, text)
+        if is_final:
+            if utt.states:
+                self._confirm(utt, utt.text, len(utt.text) - 1, utt.states[-1])
+            for end, term in utt.confirmed:
+                self.sink(self._hit(term, end, text, channel, True, start_ms, end_ms, words))
+            # The next event of this channel starts a new utterance.
+            del self.utterances[channel]
+            return
+        for end, term in utt.confirmed[new:]:
+            if (end, term) not in utt.emitted:
+                utt.emitted.add((end, term))
+                self.sink(self._hit(term, end, text, channel, False, start_ms, end_ms, words))
+
+    def feed_segment(self, segment):
+        # For Segment objects from recognition.recognize_stream(..., partials=True).
+        self.feed(segment.text, segment.is_final, segment.channel, segment.start_ms,
+                  segment.end_ms, segment.words)
+
+    def feed_response(self, response):
+        # For raw StreamingResponse messages in the existing response loops.
+        event_type = response.WhichOneof("Event")
+        if event_type not in ("partial", "final"):
+            return
+        update = getattr(response, event_type)
+        if len(update.alternatives) == 0:
+            return
+        a = update.alternatives[0]
+        words = [_Word(w.text, w.start_time_ms, w.end_time_ms) for w in a.words]
+        self.feed(a.text, event_type == "final", update.channel_tag, a.start_time_ms,
+                  a.end_time_ms, words)
+
+
+class _Word:
+    __slots__ = ("text", "start_ms", "end_ms")
+
+    def __init__(self, text, start_ms, end_ms):
+        self.text = text
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+
+
+def spot_responses(responses, spotter):
+    # Pass responses through unchanged while feeding them to spotter, so any existing
+    # response loop can spot keywords by wrapping its iterator.
+    for response in responses:
+        spotter.feed_response(response)
+        yield response
+
+
+def load_watchlist(path):
+    # One term per line; empty lines and lines starting with # are skipped.
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def jsonl_sink(f=sys.stderr):
+    def sink(hit):
+        f.write(json.dumps(hit.to_json(), ensure_ascii=False) + "\n")
+        f.flush()
+    return sink
+
+
+if __name__ == "__main__":
+    # Spot keywords in the live results of recognition.py for a file.
+    from recognition import recognize_file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("watchlist")  # Text file with one term per line
+    parser.add_argument("--language", default="en-US")
+    args = parser.parse_args()
+    spotter = KeywordSpotter(KeywordAutomaton(load_watchlist(args.watchlist)), jsonl_sink(sys.stdout))
+    for segment in recognize_file(args.path, language=args.language, partials=True, normalized=False):
+        spotter.feed_segment(segment)
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+
+# Sentinel that tells a stage worker there is no more input.
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+
+class StagedPipeline:
+    """
+    Runs items through a chain of stages, each with its own pool of worker threads.
+    Stages are connected by bounded queues, so while one item is in the last stage the
+    next ones are already in the earlier stages. A stage function receives the item and
+    may change it in place; if it raises, the item is reported as failed and skipped by
+    the remaining stages.
+    """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def _worker(self, stage, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # Let the other workers of this stage see the sentinel too.
+                inbox.put(_DONE)
+                return
+            started = time.monotonic()
+            try:
+                stage.func(item)
+            except Exception as err:
+                with self.lock:
+                    stage.failed += 1
+                    stage.busy_seconds += time.monotonic() - started
+                    self.failures.append((item, stage.name, err))
+                print(f"{stage.name} failed for {item}: {err}")
+                continue
+            with self.lock:
+                stage.completed += 1
+                stage.busy_seconds += time.monotonic() - started
+            if outbox is not None:
+                outbox.put(item)
+
+    def run(self, items):
+        """
+        Process all items and return the list of (item, stage name, exception) failures.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        pools = []
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(self.stages) else None
+            threads = [
+                threading.Thread(target=self._worker, args=(stage, queues[i], outbox),
+                                 name=f"{stage.name}-{n}", daemon=True)
+                for n in range(stage.workers)
+            ]
+            for t in threads:
+                t.start()
+            pools.append(threads)
+
+        for item in items:
+            queues[0].put(item)
+        # Shut the stages down in order, once everything before them has finished.
+        for i, threads in enumerate(pools):
+            queues[i].put(_DONE)
+            for t in threads:
+                t.join()
+        return self.failures
+
+    def report(self):
+        return {
+            s.name: {"workers": s.workers, "completed": s.completed, "failed": s.failed,
+                     "busy_seconds": round(s.busy_seconds, 1)}
+            for s in self.stages
+        }
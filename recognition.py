@@ -0,0 +1,246 @@
+import argparse
+import os
+
+import grpc
+
+import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
+import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
+
+from adaptive_concurrency import STT_LIMITER, limited_stream
+
+CHUNK_SIZE = 4000
+ENDPOINT = "api.speechkit.cloudil.com:443"
+
+CONTAINERS = {
+    "mp3": stt_pb2.ContainerAudio.MP3,
+    "wav": stt_pb2.ContainerAudio.WAV,
+    "ogg": stt_pb2.ContainerAudio.OGG_OPUS,
+}
+
+
+class Word:
+    __slots__ = ("text", "start_ms", "end_ms")
+
+    def __init__(self, text, start_ms, end_ms):
+        self.text = text
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+
+    def __repr__(self):
+        return f"Word({self.text!r}, {self.start_ms}, {self.end_ms})"
+
+
+class Segment:
+    """
+    A piece of recognized speech. Partial segments (is_final=False) can still change;
+    final segments are fixed. Times are in milliseconds from the start of the audio.
+    """
+
+    __slots__ = ("text", "start_ms", "end_ms", "words", "channel", "is_final")
+
+    def __init__(self, text, start_ms, end_ms, words=(), channel="", is_final=True):
+        self.text = text
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.words = words
+        self.channel = channel
+        self.is_final = is_final
+
+    def __repr__(self):
+        kind = "final" if self.is_final else "partial"
+        return f"Segment({kind}, {self.start_ms}-{self.end_ms}, {self.text!r})"
+
+
+def create_stub(options=None):
+    # Establish a connection with the server.
+    cred = grpc.ssl_channel_credentials()
+    channel = grpc.secure_channel(ENDPOINT, cred, options=options)
+    return stt_service_pb2_grpc.RecognizerStub(channel)
+
+
+def streaming_options(audio_format="mp3", language="en-US", sample_rate=16000,
+                      processing=stt_pb2.RecognitionModelOptions.REAL_TIME,
+                      max_pause_between_words_hint_ms=None):
+    """
+    Build recognition settings. audio_format is "mp3", "wav", "ogg" or "pcm"
+    (raw LINEAR16 mono at sample_rate).
+    """
+    if audio_format != "pcm" and audio_format not in CONTAINERS:
+        raise ValueError(f"Unsupported audio format {audio_format}, expected one of "
+                         f"{', '.join(CONTAINERS)} or pcm")
+    if audio_format == "pcm":
+        fmt = stt_pb2.AudioFormatOptions(
+            raw_audio=stt_pb2.RawAudio(
+                audio_encoding=stt_pb2.RawAudio.LINEAR16_PCM,
+                sample_rate_hertz=sample_rate,
+                audio_channel_count=1,
+            )
+        )
+    else:
+        fmt = stt_pb2.AudioFormatOptions(
+            container_audio=stt_pb2.ContainerAudio(container_audio_type=CONTAINERS[audio_format])
+        )
+    eou_classifier = None
+    if max_pause_between_words_hint_ms is not None:
+        eou_classifier = stt_pb2.EouClassifierOptions(
+            default_classifier=stt_pb2.DefaultEouClassifier(
+                type=stt_pb2.DefaultEouClassifier.DEFAULT,
+                max_pause_between_words_hint_ms=max_pause_between_words_hint_ms,
+            ),
+        )
+    return stt_pb2.StreamingOptions(
+        recognition_model=stt_pb2.RecognitionModelOptions(
+            audio_format=fmt,
+            text_normalization=stt_pb2.TextNormalizationOptions(
+                text_normalization=stt_pb2.TextNormalizationOptions.TEXT_NORMALIZATION_ENABLED,
+                profanity_filter=False,
+                literature_text=False,
+            ),
+            language_restriction=stt_pb2.LanguageRestrictionOptions(
+                restriction_type=stt_pb2.LanguageRestrictionOptions.WHITELIST,
+                language_code=[language],
+            ),
+            audio_processing_type=processing,
+        ),
+        eou_classifier=eou_classifier,
+    )
+
+
+def iter_requests(options, chunks):
+    # The first message carries the settings, all the following ones carry audio.
+    yield stt_pb2.StreamingRequest(session_options=options)
+    for data in chunks:
+        yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
+
+
+def iter_file_chunks(audio_file_name, chunk_size=CHUNK_SIZE):
+    with open(audio_file_name, "rb") as f:
+        data = f.read(chunk_size)
+        while data != b"":
+            yield data
+            data = f.read(chunk_size)
+
+
+def _segment(alternative, channel, is_final):
+    words = tuple(Word(w.text, w.start_time_ms, w.end_time_ms) for w in alternative.words)
+    return Segment(alternative.text, alternative.start_time_ms, alternative.end_time_ms,
+                   words, channel, is_final)
+
+
+def iter_segments(responses, partials=False, normalized=True):
+    """
+    Turn a RecognizeStreaming response iterator into Segment objects as they arrive.
+
+    With normalized=True each final is held back until its final_refinement arrives and
+    is yielded once with the normalized text and the final's timings and words. A final
+    that is not refined before the next final arrives (e.g. when the server does not
+    normalize) is yielded with its raw text, and a refinement that arrives after that is
+    dropped. With normalized=False finals are yielded immediately with the raw text.
+    """
+    # final_index -> Segment waiting for its refinement. The server refines finals
+    # shortly after sending them, so this holds at most a few entries.
+    pending = {}
+    for r in responses:
+        event_type = r.WhichOneof("Event")
+        if event_type == "partial":
+            if partials and len(r.partial.alternatives) > 0:
+                yield _segment(r.partial.alternatives[0], r.partial.channel_tag, False)
+        elif event_type == "final":
+            if len(r.final.alternatives) == 0:
+                continue
+            segment = _segment(r.final.alternatives[0], r.final.channel_tag, True)
+            if normalized:
+                final_index = r.audio_cursors.final_index
+                for index in sorted(i for i in pending if i < final_index):
+                    yield pending.pop(index)
+                pending[final_index] = segment
+            else:
+                yield segment
+        elif event_type == "final_refinement" and normalized:
+            update = r.final_refinement.normalized_text
+            segment = pending.pop(r.final_refinement.final_index, None)
+            if segment is None:
+                # The final was already yielded with its raw text.
+                continue
+            if len(update.alternatives) > 0:
+                segment.text = update.alternatives[0].text
+            # Anything older than this final will not be refined any more.
+            for index in sorted(i for i in pending if i < r.final_refinement.final_index):
+                yield pending.pop(index)
+            yield segment
+    for index in sorted(pending):
+        yield pending[index]
+
+
+def recognize_stream(chunks, options, stub=None, partials=False, normalized=True):
+    """
+    Recognize audio from any iterable of byte chunks (file, microphone, pipe) and yield
+    Segment objects. Nothing is buffered beyond the current response.
+    """
+    if stub is None:
+        stub = create_stub()
+    api_key = os.environ["SPEECHKIT_API_KEY"]
+    responses = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(
+        iter_requests(options, chunks), metadata=(("authorization", f"Api-Key {api_key}"),)
+    ))
+    try:
+        yield from iter_segments(responses, partials=partials, normalized=normalized)
+    except grpc.RpcError as err:
+        print(f"Error code {err.code()}, message: {err.details()}")
+        raise err
+
+
+def recognize_file(audio_file_name, audio_format=None, language="en-US", stub=None,
+                   partials=False, normalized=True, sample_rate=None, trim_silence=False,
+                   **option_kwargs):
+    """
+    Recognize an audio file and yield Segment objects:
+
+        for segment in recognize_file("audio.mp3"):
+            print(segment.start_ms, segment.end_ms, segment.text)
+
+    With sample_rate set (8000 or 16000) the file is re-encoded on the client to mono
+    MP3 at that rate and 32 kbit/s while it is sent, instead of being sent as is. Files
+    in other formats than MP3, WAV and OGG (e.g. m4a) are always re-encoded, at 16 kHz
+    unless sample_rate is set.
+
+    With trim_silence=True long pauses are also cut out before sending (see
+    silence_trim.py) and all segment and word times are mapped back to the original
+    recording.
+    """
+    if trim_silence:
+        from silence_trim import SilenceTrimmer, iter_trimmed_chunks
+
+        trimmer = SilenceTrimmer(sample_rate or 16000)
+        options = streaming_options("pcm", language, sample_rate=sample_rate or 16000, **option_kwargs)
+        chunks = iter_trimmed_chunks(audio_file_name, trimmer)
+        segments = recognize_stream(chunks, options, stub=stub, partials=partials, normalized=normalized)
+        # Cuts are recorded before the audio after them is sent, so the map always
+        # covers the segments that come back.
+        return (trimmer.offset_map.remap_segment(s) for s in segments)
+    if audio_format is None:
+        audio_format = os.path.splitext(str(audio_file_name))[1].lstrip(".").lower() or "mp3"
+    if sample_rate is not None or audio_format not in CONTAINERS:
+        # Imported here so that plain file recognition does not need NumPy.
+        from audio_preprocess import iter_mp3_file
+
+        options = streaming_options("mp3", language, **option_kwargs)
+        chunks = iter_mp3_file(audio_file_name, sample_rate or 16000)
+    else:
+        options = streaming_options(audio_format, language, **option_kwargs)
+        chunks = iter_file_chunks(audio_file_name)
+    return recognize_stream(chunks, options, stub=stub, partials=partials, normalized=normalized)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--language", default="en-US")
+    parser.add_argument("--partials", action="store_true")
+    parser.add_argument("--sample-rate", type=int, default=None, choices=[8000, 16000])
+    parser.add_argument("--trim-silence", action="store_true")
+    args = parser.parse_args()
+    segments = recognize_file(args.path, language=args.language, partials=args.partials,
+                              sample_rate=args.sample_rate, trim_silence=args.trim_silence)
+    for segment in segments:
+        print(f"{segment.start_ms} {segment.end_ms} {segment.text}")
@@ -1,4 +1,5 @@
 import argparse
+import contextlib
 import os
 from pathlib import Path
 
@@ -8,6 +9,8 @@ from reprint import output
 import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
 import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
 
+from adaptive_concurrency import STT_LIMITER, limited_stream
+
 CHUNK_SIZE = 4000
 
 
@@ -44,7 +47,9 @@ def read_audio(audio_file_name):
             data = f.read(CHUNK_SIZE)
 
 
-def recognize_audio(audio_file_name, out_file_name):
+def recognize_audio(audio_file_name, out_file_name, quiet=False):
+    # quiet=True only writes the file, e.g. when several files are recognized at once
+    # and redrawing the terminal from every thread would garble it.
     if Path(out_file_name).is_file():
         raise ValueError(f"{out_file_name} exists.")
 
@@ -55,13 +60,13 @@ def recognize_audio(audio_file_name, out_file_name):
 
     api_key = os.environ["SPEECHKIT_API_KEY"]
     # Send data for recognition.
-    it = stub.RecognizeStreaming(
+    it = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(
         read_audio(audio_file_name), metadata=(("authorization", f"Api-Key {api_key}"),)
-    )
+    ))
 
     # Process the server responses and output the result to the console and to the file.
     try:
-        with output(initial_len=1) as output_lines:
+        with contextlib.nullcontext() if quiet else output(initial_len=1) as output_lines:
             for r in it:
                 event_type, alternatives = r.WhichOneof("Event"), None
                 if event_type == "partial" and len(r.partial.alternatives) > 0:
@@ -70,12 +75,14 @@ def recognize_audio(audio_file_name, out_file_name):
                     alternatives = [a.text for a in r.final.alternatives]
                 elif event_type == "final_refinement":
                     alternatives = [a.text for a in r.final_refinement.normalized_text.alternatives]
-                    output_lines.append("")
+                    if output_lines is not None:
+                        output_lines.append("")
                     with open(out_file_name, "a") as f:
                         f.write(alternatives[0])
                 else:
                     continue
-                output_lines[-1] = alternatives[0]
+                if output_lines is not None:
+                    output_lines[-1] = alternatives[0]
     except grpc._channel._Rendezvous as err:
         print(f"Error code {err._state.code}, message: {err._state.details}")
         raise err
@@ -85,5 +92,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path")
     parser.add_argument("out_path", default="recognizer_output.txt")
+    parser.add_argument("--incremental", action="store_true")  # Only recognize audio added since the last run
     args = parser.parse_args()
-    recognize_audio(args.path, args.out_path)
+    if args.incremental:
+        from incremental_recognition import recognize_increment
+
+        # Same output as without --incremental: the normalized text only.
+        recognize_increment(args.path, args.out_path, with_times=False)
+    else:
+        recognize_audio(args.path, args.out_path)
@@ -1,50 +1,48 @@
 import argparse
 import os
-import pyaudio
-import pkg_resources
 import subprocess
 import sys
 import grpc
 from reprint import output
 
+from audio_preprocess import TARGET_RATE, Resampler, to_linear16
+from keyword_spotting import KeywordAutomaton, KeywordSpotter, jsonl_sink, load_watchlist, spot_responses
+
 import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
 import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
 
 CHUNK = 4096
-FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 44100
 RECORD_SECONDS = 5
+# Rate of the audio sent to the recognizer; the microphone signal is resampled to it.
+SEND_RATE = TARGET_RATE
 
 def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
-required_packages = ["pyaudio", "grpcio", "reprint"]
-for package in required_packages:
-    try:
-        dist = pkg_resources.get_distribution(package)
-        print('{} ({}) is installed'.format(dist.key, dist.version))
-    except pkg_resources.DistributionNotFound:
-        print('{} is NOT installed'.format(package))
-        install(package)
-
-def generate_audio_stream():
-    p = pyaudio.PyAudio()
-
-    stream = p.open(format=FORMAT,
-                    channels=CHANNELS,
-                    rate=RATE,
-                    input=True,
-                    frames_per_buffer=CHUNK)
-
-    print("* Start speaking...")
-
+def install_missing_packages():
+    import pkg_resources
+
+    required_packages = ["pyaudio", "grpcio", "reprint"]
+    for package in required_packages:
+        try:
+            dist = pkg_resources.get_distribution(package)
+            print('{} ({}) is installed'.format(dist.key, dist.version))
+        except pkg_resources.DistributionNotFound:
+            print('{} is NOT installed'.format(package))
+            install(package)
+
+def mic_requests(frames):
+    # Settings first, then every captured frame of RATE Hz audio, downmixed and
+    # resampled to SEND_RATE. Also used by soak_test.py to replay recorded frames.
     recognize_options = stt_pb2.StreamingOptions(
         recognition_model=stt_pb2.RecognitionModelOptions(
             audio_format=stt_pb2.AudioFormatOptions(
-                pcm_audio=stt_pb2.PcmAudio(
-                    sample_rate_hertz=RATE,
-                    num_channels=CHANNELS,
+                raw_audio=stt_pb2.RawAudio(
+                    audio_encoding=stt_pb2.RawAudio.LINEAR16_PCM,
+                    sample_rate_hertz=SEND_RATE,
+                    audio_channel_count=1,
                 )
             ),
             text_normalization=stt_pb2.TextNormalizationOptions(
@@ -62,15 +60,38 @@ def generate_audio_stream():
 
     yield stt_pb2.StreamingRequest(session_options=recognize_options)
 
-    try:
+    # Downmix and resample the captured audio before sending it.
+    resampler = Resampler(RATE, SEND_RATE, CHANNELS)
+    for data in frames:
+        print(f"Data Chunk: {len(data)} bytes") # log data
+        data = to_linear16(resampler.process(data))
+        yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
+
+def generate_audio_stream():
+    # Imported here so that the request and response handling can be used without an
+    # audio device.
+    import pyaudio
+
+    p = pyaudio.PyAudio()
+
+    stream = p.open(format=pyaudio.paInt16,
+                    channels=CHANNELS,
+                    rate=RATE,
+                    input=True,
+                    frames_per_buffer=CHUNK)
+
+    print("* Start speaking...")
+
+    def read_frames():
         for _ in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
             try:
-                data = stream.read(CHUNK)
-                print(f"Data Chunk: {data}") # log data
-                yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
+                yield stream.read(CHUNK)
             except IOError as e:
                 print(f"IOError during read: {e}")
                 pass
+
+    try:
+        yield from mic_requests(read_frames())
     except Exception as e:
         print(f"Exception during audio stream generation: {e}")
         stream.stop_stream()
@@ -84,7 +105,7 @@ def generate_audio_stream():
     stream.close()
     p.terminate()
 
-def recognize_audio_mic(out_file_name):
+def recognize_audio_mic(out_file_name, spotter=None):
     if os.path.isfile(out_file_name):
         raise ValueError(f"{out_file_name} exists.")
         
@@ -95,7 +116,13 @@ def recognize_audio_mic(out_file_name):
     api_key = os.environ['SPEECHKIT_API_KEY']
 
     it = stub.RecognizeStreaming(generate_audio_stream(), metadata=(('authorization', f'Api-Key {api_key}'),))
-    
+    if spotter is not None:
+        # Watchlist terms are spotted in the same partials and finals that are printed.
+        it = spot_responses(it, spotter)
+    show_responses(it, out_file_name)
+
+def show_responses(it, out_file_name):
+    # Show partials and finals as they change and append the normalized text to the file.
     try:
         with output(initial_len=1) as output_lines:
             for r in it:
@@ -119,7 +146,14 @@ def recognize_audio_mic(out_file_name):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("out_path", default="recognizer_output.txt")
+    parser.add_argument("--keywords", default=None)  # Watchlist file, one term per line
     args = parser.parse_args()
-    recognize_audio_mic(args.out_path)
+    install_missing_packages()
+    if args.keywords:
+        with open(f"{args.out_path}.hits.jsonl", "a") as hits_file:
+            spotter = KeywordSpotter(KeywordAutomaton(load_watchlist(args.keywords)), jsonl_sink(hits_file))
+            recognize_audio_mic(args.out_path, spotter)
+    else:
+        recognize_audio_mic(args.out_path)
 
 
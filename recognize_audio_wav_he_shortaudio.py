@@ -8,6 +8,8 @@ from reprint import output
 import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
 import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
 
+from adaptive_concurrency import STT_LIMITER, limited_stream
+
 CHUNK_SIZE = 500
 
 def read_audio(audio_file_name):
@@ -60,9 +62,9 @@ def recognize_audio(audio_file_name, out_file_name):
 
     api_key = os.environ["SPEECHKIT_API_KEY"]
     # Send data for recognition.
-    it = stub.RecognizeStreaming(
+    it = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(
         read_audio(audio_file_name), metadata=(("authorization", f"Api-Key {api_key}"),)
-    )
+    ))
 
     # Process the server responses and output the result to the console and to the file.
     try:
@@ -7,9 +7,44 @@ from reprint import output
 import json
 import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
 import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
+
+from adaptive_concurrency import STT_LIMITER, limited_stream
  
 # Define the chunk size for audio processing
 CHUNK_SIZE = 4000
+
+
+class WordWriter:
+    """
+    Writes word records incrementally. "jsonl" writes one JSON object per line, so the
+    file is usable even if the process dies; "json" streams a single JSON list that is
+    complete once close() is called.
+    """
+
+    def __init__(self, f, out_format="jsonl"):
+        if out_format not in ("jsonl", "json"):
+            raise ValueError(f"Unknown output format {out_format}")
+        self.f = f
+        self.out_format = out_format
+        self.count = 0
+        if out_format == "json":
+            f.write("[")
+
+    def write(self, word, start_ms, end_ms):
+        record = json.dumps({"word": word, "startMS": start_ms, "endMS": end_ms}, ensure_ascii=False)
+        if self.out_format == "jsonl":
+            self.f.write(record + "\n")
+        else:
+            self.f.write(("," if self.count else "") + "\n    " + record)
+        self.count += 1
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.out_format == "json":
+            self.f.write("\n]\n")
+        self.f.flush()
  
 def read_audio(audio_file_name):
     # Specify the recognition settings.
@@ -50,7 +85,7 @@ def read_audio(audio_file_name):
             yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
             data = f.read(CHUNK_SIZE)
  
-def recognize_audio(audio_file_name, out_file_name):
+def recognize_audio(audio_file_name, out_file_name, out_format="jsonl"):
     if Path(out_file_name).is_file():
         raise ValueError(f"{out_file_name} exists.")
 
@@ -61,44 +96,44 @@ def recognize_audio(audio_file_name, out_file_name):
 
     api_key = os.environ["SPEECHKIT_API_KEY"]
     # Send data for recognition.
-    it = stub.RecognizeStreaming(
+    it = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(
         read_audio(audio_file_name), metadata=(("authorization", f"Api-Key {api_key}"),)
-    )
+    ))
 
-    results = []
+    # final_index -> (startMS, endMS) of finals that have not been refined yet.
+    final_spans = {}
 
     # Process the server responses and output the result to the console and to the file.
     try:
-        with output(initial_len=1) as output_lines:
+        with output(initial_len=1) as output_lines, open(out_file_name, "w") as f:
+            writer = WordWriter(f, out_format)
             for r in it:
                 event_type, alternatives = r.WhichOneof("Event"), None
                 if event_type == "partial" and len(r.partial.alternatives) > 0:
                     alternatives = [a.text for a in r.partial.alternatives]
                 elif event_type == "final":
                     alternatives = [a.text for a in r.final.alternatives]
-                    # Save word timestamps to the output file
+                    # Save word timestamps to the output file as soon as the final arrives,
+                    # so memory does not grow with the length of the recording.
                     for a in r.final.alternatives:
                         for w in a.words:
-                            results.append({
-                                "word": w.text,
-                                "startMS": w.start_time_ms,
-                                "endMS": w.end_time_ms
-                            })
+                            writer.write(w.text, w.start_time_ms, w.end_time_ms)
+                    writer.flush()
+                    if len(r.final.alternatives) > 0:
+                        a = r.final.alternatives[0]
+                        final_spans[r.audio_cursors.final_index] = (a.start_time_ms, a.end_time_ms)
                 elif event_type == "final_refinement":
                     alternatives = [a.text for a in r.final_refinement.normalized_text.alternatives]
                     output_lines.append("")
-                    results.append({
-                        "word": alternatives[0],
-                        "startMS": None,  # You need to determine these values
-                        "endMS": None     # You need to determine these values
-                    })
+                    # The refinement covers the same time frame as the final it refines.
+                    start_ms, end_ms = final_spans.pop(r.final_refinement.final_index, (None, None))
+                    writer.write(alternatives[0], start_ms, end_ms)
+                    writer.flush()
                 else:
                     continue
                 output_lines[-1] = alternatives[0]
+            writer.close()
 
-        with open(out_file_name, 'w') as f:
-            json.dump(results, f, ensure_ascii=False, indent=4)
-            
     except grpc.RpcError as err:
         print(f"Error code {err.code()}, message: {err.details()}")
         raise err
@@ -107,5 +142,6 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path")
     parser.add_argument("--out_path", default="recognizer_output.txt")
+    parser.add_argument("--format", choices=["jsonl", "json"], default="jsonl")
     args = parser.parse_args()
-    recognize_audio(args.path, args.out_path)
\ No newline at end of file
+    recognize_audio(args.path, args.out_path, args.format)
\ No newline at end of file
@@ -1,37 +1,115 @@
 import argparse
+import json
 from pathlib import Path
 from extract_audio import extract_audio
 
+from adaptive_concurrency import STT_LIMITER, TTS_LIMITER, metrics
+from pipeline import Stage, StagedPipeline
 from recognize_audio import recognize_audio
 from summarize import summarize
-from text_to_speech import synthesize
+from text_to_speech import synthesize_to_file
 
+VIDEO_SUFFIXES = {".mp4", ".mov", ".mkv", ".avi", ".webm"}
+
+
+class Video:
+    def __init__(self, video_path):
+        self.video_path = Path(video_path)
+        self.audio_path = self.video_path.with_suffix('.mp3')
+        self.text_path = self.video_path.with_suffix('.txt')
+        self.summary_path = self.video_path.with_suffix('.summary.mp3')
+        self.summary = None
+
+    def __str__(self):
+        return str(self.video_path)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('video_path')
-    args = parser.parse_args()
 
-    video_path = Path(args.video_path)
-    audio_path = video_path.with_suffix('.mp3')
-    text_path = video_path.with_suffix('.txt')
-    summary_path = video_path.with_suffix('.summary.mp3')
+def extract_stage(video):
     try:
-        extract_audio(args.video_path, out_path=audio_path)
+        extract_audio(str(video.video_path), out_path=video.audio_path)
     except ValueError:
-        print(f"{audio_path} exists, using existing file.")
+        print(f"{video.audio_path} exists, using existing file.")
 
-    print("Speech recognition...")
+
+def recognize_stage(video, quiet=False):
     try:
-        recognize_audio(audio_path, text_path)
-        print("Speech recognition finished.")
+        recognize_audio(video.audio_path, video.text_path, quiet=quiet)
+        print(f"Speech recognition of {video} finished.")
     except ValueError:
-        print(f"{text_path} exists, using existing file.")
+        print(f"{video.text_path} exists, using existing file.")
+
+
+def summarize_stage(video):
+    video.summary = summarize(video.text_path)
+    video.video_path.with_suffix('.summary.txt').write_text(video.summary)
+
+
+def synthesize_stage(video):
+    # The summary audio is written while it is synthesized, so it can be played early.
+    synthesize_to_file(video.summary, video.summary_path)
+    print(f"Summary of {video} is in {video.summary_path}")
+
+
+def find_videos(paths):
+    videos = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            videos.extend(p for p in sorted(path.iterdir()) if p.suffix.lower() in VIDEO_SUFFIXES)
+        else:
+            videos.append(path)
+    return videos
+
+
+def run_batch(video_paths, extract_workers=2, recognize_workers=4, summarize_workers=2, tts_workers=2):
+    """
+    Process many videos at once. Every stage has its own pool sized for its bottleneck
+    (CPU for extraction, SpeechKit sessions for recognition and synthesis, the LLM API
+    for summarization), and videos move on to the next stage as soon as they are ready.
+    """
+    STT_LIMITER.seed(recognize_workers)
+    TTS_LIMITER.seed(tts_workers)
+    pipeline = StagedPipeline([
+        Stage("extract", extract_stage, extract_workers),
+        # Recognized text is not shown, as the workers would redraw the terminal at once.
+        Stage("recognize", lambda video: recognize_stage(video, quiet=True), recognize_workers),
+        Stage("summarize", summarize_stage, summarize_workers),
+        Stage("synthesize", synthesize_stage, tts_workers),
+    ])
+    failures = pipeline.run(Video(p) for p in video_paths)
+    print(json.dumps(pipeline.report(), indent=4))
+    # Where the adaptive SpeechKit limits ended up, and why they last changed.
+    for limiter in metrics():
+        changes = limiter["changes"]
+        last = f", last change: {changes[-1]['reason']}" if changes else ""
+        print(f"{limiter['name']} concurrency limit: {limiter['limit']}{last}")
+    for video, stage, err in failures:
+        print(f"{video}: {stage} failed: {err}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video_path', nargs='+')  # Video files or directories with videos
+    parser.add_argument('--extract-workers', type=int, default=2)
+    parser.add_argument('--recognize-workers', type=int, default=4)
+    parser.add_argument('--summarize-workers', type=int, default=2)
+    parser.add_argument('--tts-workers', type=int, default=2)
+    args = parser.parse_args()
+
+    videos = find_videos(args.video_path)
+    if len(videos) != 1 or Path(args.video_path[0]).is_dir():
+        run_batch(videos, args.extract_workers, args.recognize_workers,
+                  args.summarize_workers, args.tts_workers)
+    else:
+        video = Video(videos[0])
+        extract_stage(video)
+
+        print("Speech recognition...")
+        recognize_stage(video)
 
-    print("Summarizing...")
-    result = summarize(text_path)
-    print(result)
+        print("Summarizing...")
+        video.summary = summarize(video.text_path)
+        print(video.summary)
 
-    print("Running speech synthesis...")
-    audio_bytes = synthesize(result)
-    summary_path.write_bytes(audio_bytes.getbuffer())
+        print("Running speech synthesis...")
+        synthesize_stage(video)
@@ -0,0 +1,185 @@
+import argparse
+import bisect
+import json
+from array import array
+from collections import deque
+
+import numpy as np
+
+from audio_preprocess import TARGET_RATE, iter_linear16_file
+
+# Length of the frames voice activity is decided on.
+FRAME_MS = 10
+# Frames quieter than this (dB relative to full scale) count as silence.
+THRESHOLD_DBFS = -45.0
+# Pauses shorter than this are sent as is, so the recognizer still sees natural pauses.
+MIN_SILENCE_MS = 1000
+# Silence kept before and after speech when a longer pause is cut out.
+PADDING_MS = 300
+
+
+class OffsetMap:
+    """
+    Maps times in the trimmed audio back to times in the original recording.
+    Entry i says that trimmed time trimmed_ms[i] corresponds to original time
+    original_ms[i], and time runs at the same pace until the next entry.
+    """
+
+    def __init__(self):
+        self.trimmed_ms = array("q", [0])
+        self.original_ms = array("q", [0])
+
+    def add(self, trimmed_ms, original_ms):
+        if self.trimmed_ms[-1] == trimmed_ms:
+            self.original_ms[-1] = original_ms
+        else:
+            self.trimmed_ms.append(trimmed_ms)
+            self.original_ms.append(original_ms)
+
+    def to_original(self, trimmed_ms):
+        i = bisect.bisect_right(self.trimmed_ms, trimmed_ms) - 1
+        return self.original_ms[i] + (trimmed_ms - self.trimmed_ms[i])
+
+    def remap_segment(self, segment):
+        segment.start_ms = self.to_original(segment.start_ms)
+        segment.end_ms = self.to_original(segment.end_ms)
+        for word in segment.words:
+            word.start_ms = self.to_original(word.start_ms)
+            word.end_ms = self.to_original(word.end_ms)
+        return segment
+
+    def to_json(self):
+        return {"trimmed_ms": list(self.trimmed_ms), "original_ms": list(self.original_ms)}
+
+
+def frame_levels_dbfs(samples, frame_len):
+    """
+    RMS level of every full frame of int16 samples, in dB relative to full scale.
+    """
+    frames = np.asarray(samples, dtype=np.float32)[:len(samples) // frame_len * frame_len]
+    rms = np.sqrt(np.mean(frames.reshape(-1, frame_len) ** 2, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1.0) / 32768.0)
+
+
+class SilenceTrimmer:
+    """
+    Streaming removal of long pauses from mono LINEAR16 audio. Feed blocks of any size
+    with process(); it returns the audio to send and records every cut in offset_map.
+    At most MIN_SILENCE_MS of audio is buffered.
+    """
+
+    def __init__(self, sample_rate=TARGET_RATE, threshold_dbfs=THRESHOLD_DBFS,
+                 min_silence_ms=MIN_SILENCE_MS, padding_ms=PADDING_MS):
+        self.frame_len = sample_rate * FRAME_MS // 1000
+        self.threshold_dbfs = threshold_dbfs
+        self.padding = padding_ms // FRAME_MS
+        self.min_silence = max(min_silence_ms // FRAME_MS, 2 * self.padding)
+        self.offset_map = OffsetMap()
+        self.leftover = np.zeros(0, dtype="<i2")
+        # Frames seen and sent so far.
+        self.in_frames = 0
+        self.out_frames = 0
+        # Current run of silent frames: how long it is, the frames held back while it
+        # may still turn out to be a short pause, and the last frames once it is long.
+        self.silent_run = 0
+        self.held = []
+        self.tail = deque(maxlen=self.padding)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _emit(self, frames, out):
+        out.extend(frames)
+        self.out_frames += len(frames)
+
+    def process(self, data):
+        samples = np.concatenate([self.leftover, np.frombuffer(data, dtype="<i2")])
+        n_frames = len(samples) // self.frame_len
+        self.leftover = samples[n_frames * self.frame_len:]
+        if n_frames == 0:
+            return b""
+        speech = frame_levels_dbfs(samples, self.frame_len) > self.threshold_dbfs
+        frames = samples[:n_frames * self.frame_len].reshape(n_frames, self.frame_len)
+
+        out = []
+        for frame, is_speech in zip(frames, speech):
+            self.in_frames += 1
+            if not is_speech:
+                self.silent_run += 1
+                if self.silent_run <= self.padding:
+                    # Silence right after speech is always kept.
+                    self._emit([frame], out)
+                elif self.silent_run <= self.min_silence:
+                    self.held.append(frame)
+                else:
+                    if self.held:
+                        # The pause is long: drop what was held except the last frames.
+                        self.tail.extend(self.held)
+                        self.held = []
+                    self.tail.append(frame)
+                continue
+
+            if self.silent_run > self.min_silence:
+                # Cut: the next sent frame is the first of the kept leading padding.
+                original_frame = self.in_frames - 1 - len(self.tail)
+                self.offset_map.add(self.out_frames * FRAME_MS, original_frame * FRAME_MS)
+                self._emit(list(self.tail), out)
+            elif self.held:
+                self._emit(self.held, out)
+            self.held = []
+            self.tail.clear()
+            self.silent_run = 0
+            self._emit([frame], out)
+
+        data_out = b"".join(f.tobytes() for f in out)
+        self.bytes_in += n_frames * self.frame_len * 2
+        self.bytes_out += len(data_out)
+        return data_out
+
+    def flush(self):
+        # Trailing silence is never needed; only a short held pause is sent.
+        out = []
+        if self.silent_run <= self.min_silence and self.held:
+            self._emit(self.held, out)
+        self.held = []
+        data_out = b"".join(f.tobytes() for f in out) + self.leftover.tobytes()
+        self.bytes_out += len(data_out)
+        self.leftover = np.zeros(0, dtype="<i2")
+        return data_out
+
+
+def iter_trimmed_chunks(path, trimmer):
+    """
+    Decode a file to mono LINEAR16 at the trimmer's rate and yield the audio with long
+    pauses removed.
+    """
+    sample_rate = trimmer.frame_len * 1000 // FRAME_MS
+    for block in iter_linear16_file(path, sample_rate):
+        data = trimmer.process(block)
+        if data:
+            yield data
+    data = trimmer.flush()
+    if data:
+        yield data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--out", default=None)  # Write the trimmed LINEAR16 audio here
+    parser.add_argument("--threshold-dbfs", type=float, default=THRESHOLD_DBFS)
+    parser.add_argument("--min-silence-ms", type=int, default=MIN_SILENCE_MS)
+    args = parser.parse_args()
+
+    trimmer = SilenceTrimmer(threshold_dbfs=args.threshold_dbfs, min_silence_ms=args.min_silence_ms)
+    out = open(args.out, "wb") if args.out else None
+    for chunk in iter_trimmed_chunks(args.path, trimmer):
+        if out:
+            out.write(chunk)
+    if out:
+        out.close()
+    print(json.dumps({
+        "bytes_in": trimmer.bytes_in,
+        "bytes_out": trimmer.bytes_out,
+        "reduction": round(trimmer.bytes_in / max(1, trimmer.bytes_out), 2),
+        "cuts": len(trimmer.offset_map.trimmed_ms) - 1,
+    }))
@@ -0,0 +1,328 @@
+import argparse
+import bisect
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+import grpc
+
+import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
+import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
+
+from audio_preprocess import TARGET_RATE, iter_pcm_windows
+from recognize_audio_mic import CHANNELS, CHUNK, RATE, mic_requests, show_responses
+
+# Audio sent per request: one microphone read of CHUNK samples at RATE.
+FRAME_MS = CHUNK * 1000 / RATE
+# How far the sender may fall behind before the microphone buffer overruns and frames
+# are dropped.
+MIC_BUFFER_MS = 1000
+# The fake recognizer sends a partial every PARTIAL_EVERY_MS and a final every
+# FINAL_EVERY_MS of received audio.
+PARTIAL_EVERY_MS = 300
+FINAL_EVERY_MS = 3000
+
+
+class FakeRecognizer(stt_service_pb2_grpc.RecognizerServicer):
+    """
+    Local stand-in for the SpeechKit recognizer: consumes LINEAR16 audio and answers
+    with partial and final events whose cursors follow the received audio.
+    """
+
+    def __init__(self, sample_rate=TARGET_RATE, processing_delay_ms=0):
+        self.bytes_per_ms = sample_rate * 2 / 1000
+        self.processing_delay = processing_delay_ms / 1000
+
+    def _response(self, event, received_ms, final_ms, final_index, text):
+        alternative = stt_pb2.Alternative(text=text, start_time_ms=final_ms, end_time_ms=received_ms)
+        update = stt_pb2.AlternativeUpdate(alternatives=[alternative], channel_tag="0")
+        cursors = stt_pb2.AudioCursors(
+            received_data_ms=received_ms,
+            partial_time_ms=received_ms,
+            final_time_ms=final_ms if event == "partial" else received_ms,
+            final_index=final_index,
+        )
+        return stt_pb2.StreamingResponse(audio_cursors=cursors, **{event: update})
+
+    def RecognizeStreaming(self, request_iterator, context):
+        received = 0
+        next_partial, next_final = PARTIAL_EVERY_MS, FINAL_EVERY_MS
+        final_ms, final_index = 0, 0
+        for request in request_iterator:
+            if request.WhichOneof("Event") != "chunk":
+                continue
+            received += len(request.chunk.data)
+            received_ms = int(received / self.bytes_per_ms)
+            if self.processing_delay:
+                time.sleep(self.processing_delay)
+            if received_ms >= next_final:
+                yield self._response("final", received_ms, final_ms, final_index, "final")
+                normalized = stt_pb2.AlternativeUpdate(alternatives=[stt_pb2.Alternative(text="Final.")])
+                yield stt_pb2.StreamingResponse(final_refinement=stt_pb2.FinalRefinement(
+                    final_index=final_index, normalized_text=normalized))
+                final_ms, final_index = received_ms, final_index + 1
+                next_final += FINAL_EVERY_MS
+                next_partial = received_ms + PARTIAL_EVERY_MS
+            elif received_ms >= next_partial:
+                yield self._response("partial", received_ms, final_ms, final_index, "partial")
+                next_partial += PARTIAL_EVERY_MS
+
+
+def serve(port, processing_delay_ms=0, max_workers=256):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    stt_service_pb2_grpc.add_RecognizerServicer_to_server(
+        FakeRecognizer(processing_delay_ms=processing_delay_ms), server
+    )
+    server.add_insecure_port(f"127.0.0.1:{port}")
+    server.start()
+    server.wait_for_termination()
+
+
+class Histogram:
+    """
+    Log-spaced histogram (about 2% resolution) so that hours-long soak runs keep
+    constant memory and do not inflate the RSS being measured.
+    """
+
+    BUCKETS_PER_E = 50
+
+    def __init__(self, max_value=600000):
+        self.counts = [0] * (self._bucket(max_value) + 1)
+        self.total = 0
+        self.max = 0.0
+
+    def _bucket(self, value):
+        return int(math.log1p(max(0.0, value)) * self.BUCKETS_PER_E)
+
+    def append(self, value):
+        self.counts[min(self._bucket(value), len(self.counts) - 1)] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def merge_all(self, others):
+        for other in others:
+            self.merge(other)
+        return self
+
+    def percentile(self, q):
+        rank = q * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen > rank:
+                return math.expm1((i + 1) / self.BUCKETS_PER_E)
+        return self.max
+
+
+class StreamStats:
+    def __init__(self):
+        self.partial_latency_ms = Histogram()
+        self.final_latency_ms = Histogram()
+        self.sender_lag_ms = Histogram()
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.errors = 0
+
+
+class SimulatedMicrophone:
+    """
+    Replays RATE Hz audio at real-time pace as one live stream through the same
+    resampling and response handling as recognize_audio_mic.py, and measures how long
+    each partial and final takes to arrive after the audio it covers was sent.
+    """
+
+    def __init__(self, stub, audio, duration_s, stats, out_file_name):
+        self.stub = stub
+        self.audio = audio
+        self.duration_s = duration_s
+        self.stats = stats
+        self.out_file_name = out_file_name
+        self.frame_bytes = CHUNK * CHANNELS * 2
+        # Parallel lists: audio time sent so far (ms) and wall time it was sent.
+        self.sent_audio_ms = []
+        self.sent_wall = []
+        self.lock = threading.Lock()
+
+    def _frames(self):
+        started = time.monotonic()
+        frames_total = int(self.duration_s * 1000 / FRAME_MS)
+        offset = 0
+        audio_ms = 0
+        for i in range(frames_total):
+            deadline = started + (i + 1) * FRAME_MS / 1000
+            now = time.monotonic()
+            if now < deadline:
+                time.sleep(deadline - now)
+                now = time.monotonic()
+            lag_ms = (now - deadline) * 1000
+            self.stats.sender_lag_ms.append(lag_ms)
+            if lag_ms > MIC_BUFFER_MS:
+                # The microphone buffer overran while we were late: this frame is lost.
+                self.stats.frames_dropped += 1
+                continue
+            frame = self.audio[offset:offset + self.frame_bytes]
+            offset += self.frame_bytes
+            if len(frame) < self.frame_bytes:
+                # Loop the recording for soak runs longer than the file.
+                offset = self.frame_bytes - len(frame)
+                frame += self.audio[:offset]
+            audio_ms += FRAME_MS
+            with self.lock:
+                self.sent_audio_ms.append(audio_ms)
+                self.sent_wall.append(time.monotonic())
+            self.stats.frames_sent += 1
+            yield frame
+
+    def _sent_at(self, audio_ms, trim=False):
+        with self.lock:
+            i = bisect.bisect_left(self.sent_audio_ms, audio_ms)
+            sent = self.sent_wall[i] if i < len(self.sent_wall) else None
+            if trim:
+                # Cursors never go back before the last final, so older entries are not
+                # needed any more and the lists stay short during long runs.
+                del self.sent_audio_ms[:i]
+                del self.sent_wall[:i]
+            return sent
+
+    def _measure(self, responses):
+        for r in responses:
+            event_type = r.WhichOneof("Event")
+            sent = None
+            if event_type == "partial":
+                sent = self._sent_at(r.audio_cursors.partial_time_ms)
+                target = self.stats.partial_latency_ms
+            elif event_type == "final":
+                sent = self._sent_at(r.audio_cursors.final_time_ms, trim=True)
+                target = self.stats.final_latency_ms
+            if sent is not None:
+                target.append((time.monotonic() - sent) * 1000)
+            yield r
+
+    def run(self):
+        try:
+            responses = self.stub.RecognizeStreaming(mic_requests(self._frames()))
+            show_responses(self._measure(responses), self.out_file_name)
+        except grpc.RpcError:
+            self.stats.errors += 1
+
+
+def _percentiles(histogram):
+    if not histogram.total:
+        return None
+    pick = lambda q: round(min(histogram.percentile(q), histogram.max), 1)
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(histogram.max, 1)}
+
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def run_level(target, audio, streams, duration_s, sample_interval=5):
+    channel = grpc.insecure_channel(target)
+    stub = stt_service_pb2_grpc.RecognizerStub(channel)
+    stats = [StreamStats() for _ in range(streams)]
+    out_dir = tempfile.TemporaryDirectory()
+    mics = [SimulatedMicrophone(stub, audio, duration_s, s, os.path.join(out_dir.name, f"{i}.txt"))
+            for i, s in enumerate(stats)]
+    threads = [threading.Thread(target=m.run, daemon=True) for m in mics]
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.monotonic()
+    rss = []
+    # The microphone script prints every frame and result; that work is measured, but
+    # the output of many streams is not shown.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            rss.append(_rss_mb())
+            for t in threads:
+                t.join(timeout=sample_interval / len(threads))
+    wall = time.monotonic() - wall_start
+    out_dir.cleanup()
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    channel.close()
+
+    merged = lambda name: Histogram().merge_all(getattr(s, name) for s in stats)
+    return {
+        "streams": streams,
+        "partial_latency_ms": _percentiles(merged("partial_latency_ms")),
+        "final_latency_ms": _percentiles(merged("final_latency_ms")),
+        "sender_lag_ms": _percentiles(merged("sender_lag_ms")),
+        "frames_sent": sum(s.frames_sent for s in stats),
+        "frames_dropped": sum(s.frames_dropped for s in stats),
+        "errors": sum(s.errors for s in stats),
+        "client_cpu_percent": round(100 * cpu / wall, 1),
+        "client_rss_mb_max": round(max(rss), 1) if rss else None,
+    }
+
+
+def sustainable(report, max_lag_ms):
+    lag = report["sender_lag_ms"]
+    return (report["frames_dropped"] == 0 and report["errors"] == 0
+            and lag is not None and lag["p99"] <= max_lag_ms)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_path")  # WAV or MP3 file to replay
+    parser.add_argument("--streams", default="1,2,4,8,16,32")  # Concurrent microphones per level
+    parser.add_argument("--duration", type=float, default=60)  # Seconds per level, e.g. 14400 for a 4-hour soak
+    parser.add_argument("--port", type=int, default=50151)
+    parser.add_argument("--target", default=None)  # Use an already running recognizer instead of the fake one
+    parser.add_argument("--processing-delay-ms", type=float, default=0)
+    parser.add_argument("--max-lag-ms", type=float, default=FRAME_MS)
+    parser.add_argument("--report", default=None)  # Write the JSON report to this file
+    args = parser.parse_args()
+
+    # Replayed like microphone input, at the rate and channel count the microphone
+    # script captures.
+    audio = b"".join(w.data for w in iter_pcm_windows(args.audio_path, 1000, RATE, CHANNELS))
+
+    server = None
+    target = args.target
+    if target is None:
+        # The fake recognizer runs in its own process so it does not skew client CPU numbers.
+        server = multiprocessing.Process(
+            target=serve, args=(args.port, args.processing_delay_ms), daemon=True
+        )
+        server.start()
+        target = f"127.0.0.1:{args.port}"
+        grpc.channel_ready_future(grpc.insecure_channel(target)).result(timeout=10)
+
+    reports = []
+    max_sustained = 0
+    try:
+        for streams in (int(n) for n in args.streams.split(",")):
+            report = run_level(target, audio, streams, args.duration)
+            report["sustainable"] = sustainable(report, args.max_lag_ms)
+            reports.append(report)
+            print(json.dumps(report))
+            if not report["sustainable"]:
+                break
+            max_sustained = streams
+    finally:
+        if server is not None:
+            server.terminate()
+
+    summary = {"max_sustainable_streams": max_sustained, "levels": reports}
+    print(f"One worker process sustained {max_sustained} concurrent live streams.")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(summary, f, indent=4)
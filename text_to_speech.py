@@ -4,14 +4,29 @@ import re
 import grpc
 import argparse
 import os
+import queue
+import sys
+import threading
+import time
 
 import yandex.cloud.ai.tts.v3.tts_pb2 as tts_pb2
 import yandex.cloud.ai.tts.v3.tts_service_pb2_grpc as tts_service_pb2_grpc
 
+from adaptive_concurrency import TTS_LIMITER, limited_stream
+
 TEXT_LENGTH_LIMIT = 240
+# Maximum number of audio chunks buffered between synthesis and the output file.
+MAX_BUFFERED_CHUNKS = 64
+
 
+def create_stub():
+    # Establish connection with server.
+    cred = grpc.ssl_channel_credentials()
+    channel = grpc.secure_channel("api.speechkit.cloudil.com:443", cred)
+    return tts_service_pb2_grpc.SynthesizerStub(channel)
 
-def synthesize_batch(text):
+
+def iter_batch_chunks(text, stub=None):
     api_key = os.environ["SPEECHKIT_API_KEY"]
 
     # Define request parameters.
@@ -28,47 +43,87 @@ def synthesize_batch(text):
         hints=[tts_pb2.Hints(voice="john")],
     )
 
-    # Establish connection with server.
-    cred = grpc.ssl_channel_credentials()
-    channel = grpc.secure_channel("api.speechkit.cloudil.com:443", cred)
-    stub = tts_service_pb2_grpc.SynthesizerStub(channel)
+    if stub is None:
+        stub = create_stub()
 
     # Send data for synthesis.
-    it = stub.UtteranceSynthesis(
+    it = limited_stream(TTS_LIMITER, lambda: stub.UtteranceSynthesis(
         request, metadata=(("authorization", f"Api-Key {api_key}"),)
-    )
+    ))
 
-    # Merge chunks into BytesIO buffer chunks.
+    # Yield audio chunks as soon as the server sends them.
     try:
-        audio = io.BytesIO()
         for response in it:
-            audio.write(response.audio_chunk.data)
-        audio.seek(0)
-        return audio
+            yield response.audio_chunk.data
     except grpc._channel._Rendezvous as err:
         print(f"Error code {err._state.code}, message: {err._state.details}")
         raise err
 
 
-def split_batches(text):
-    sentences = re.split(r"(?<=[\.\!\?])", text)
-    for sent in sentences:
+def synthesize_batch(text, stub=None):
+    # Merge chunks into BytesIO buffer chunks.
+    audio = io.BytesIO()
+    for data in iter_batch_chunks(text, stub):
+        audio.write(data)
+    audio.seek(0)
+    return audio
+
+
+# Sentence ends, and clause boundaries used to split sentences longer than the limit.
+SENTENCE_END = re.compile(r"(?<=[\.\!\?])\s+")
+CLAUSE_END = re.compile(r"(?<=[,;:\u2014])\s+")
+
+
+def _split_long(piece, limit, boundaries):
+    # Split text longer than limit at the first kind of boundary that helps: clause
+    # punctuation, then whitespace, then a hard cut for a single over-long word.
+    if len(piece) <= limit:
+        yield piece
+        return
+    if not boundaries:
+        for start in range(0, len(piece), limit):
+            yield piece[start:start + limit]
+        return
+    parts = boundaries[0].split(piece)
+    if len(parts) == 1:
+        yield from _split_long(piece, limit, boundaries[1:])
+        return
+    for packed in _pack(parts, limit):
+        yield from _split_long(packed, limit, boundaries[1:])
+
+
+def _pack(pieces, limit):
+    # Greedily join consecutive pieces with a space while they fit into limit.
+    batch, batch_len = [], 0
+    for piece in pieces:
+        if batch and batch_len + 1 + len(piece) > limit:
+            yield " ".join(batch)
+            batch, batch_len = [], 0
+        batch.append(piece)
+        batch_len += len(piece) + (1 if batch_len else 0)
+    if batch:
+        yield " ".join(batch)
+
+
+def plan_batches(text, limit=TEXT_LENGTH_LIMIT):
+    """
+    Split text into as few synthesis requests as possible: consecutive sentences are
+    combined while they fit into limit characters, and longer sentences are split at
+    clause boundaries, then between words. Runs in linear time.
+    Returns a list of (batch_text, number_of_characters).
+    """
+    boundaries = (CLAUSE_END, re.compile(r"\s+"))
+    pieces = []
+    for sent in SENTENCE_END.split(text):
         sent = sent.strip()
-        if not sent:
-            continue
-        if len(sent) <= TEXT_LENGTH_LIMIT:
-            yield sent
-        else:
-            words = sent.split()
-            batch = ""
-            for word in words:
-                if len(batch + word) > TEXT_LENGTH_LIMIT and batch:
-                    yield batch
-                    batch = word
-                else:
-                    batch += " " + word
-            if batch:
-                yield batch
+        if sent:
+            pieces.extend(_split_long(sent, limit, boundaries))
+    return [(batch, len(batch)) for batch in _pack(pieces, limit)]
+
+
+def split_batches(text):
+    for batch, _ in plan_batches(text):
+        yield batch
 
 
 def synthesize(text):
@@ -81,13 +136,90 @@ def synthesize(text):
     return merged_bytes
 
 
+def synthesize_stream(text, max_buffered_chunks=MAX_BUFFERED_CHUNKS):
+    """
+    Yield audio chunks in batch order while the text is being synthesized.
+
+    Synthesis runs in a background thread that stays at most max_buffered_chunks ahead
+    of the consumer, so memory does not grow with the length of the text.
+    """
+    chunks = queue.Queue(maxsize=max_buffered_chunks)
+    done = object()
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        # Wait for room in the buffer, but give up if the consumer went away.
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            stub = create_stub()
+            for batch in split_batches(text):
+                for data in iter_batch_chunks(batch, stub):
+                    if not put(data):
+                        return
+        except Exception as err:
+            errors.append(err)
+        finally:
+            put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            data = chunks.get()
+            if data is done:
+                break
+            yield data
+    finally:
+        stop.set()
+    if errors:
+        raise errors[0]
+
+
+def synthesize_to_file(text, out, max_buffered_chunks=MAX_BUFFERED_CHUNKS):
+    """
+    Write audio to out (a path, or "-" for stdout) as it is synthesized.
+    Returns the time to first audio in seconds, or None if nothing was synthesized.
+    """
+    started = time.monotonic()
+    first_audio = None
+    f = sys.stdout.buffer if str(out) == "-" else open(out, "wb")
+    try:
+        for data in synthesize_stream(text, max_buffered_chunks):
+            if first_audio is None:
+                first_audio = time.monotonic() - started
+                print(f"Time to first audio: {first_audio:.2f} s", file=sys.stderr)
+            f.write(data)
+            f.flush()
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+    return first_audio
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("text_file")
-    parser.add_argument("--output", default="output.mp3")
+    parser.add_argument("--output", default="output.mp3")  # "-" writes the audio to stdout
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--plan", action="store_true")  # Only print the batch plan
     args = parser.parse_args()
 
     with open(args.text_file) as f:
         input_text = f.read()
-    audio_bytes = synthesize(input_text)
-    Path(args.output).write_bytes(audio_bytes.getbuffer())
+    if args.plan:
+        for batch, length in plan_batches(input_text):
+            print(f"{length:4d} {batch}")
+    elif args.no_stream:
+        audio_bytes = synthesize(input_text)
+        Path(args.output).write_bytes(audio_bytes.getbuffer())
+    else:
+        synthesize_to_file(input_text, args.output)
@@ -1,42 +1,63 @@
 import argparse
+import contextlib
 import os
 from pathlib import Path
 import grpc
 from reprint import output
 import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
 import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
-from pydub import AudioSegment
-from pydub.utils import make_chunks
 import glob
 
+from adaptive_concurrency import STT_LIMITER, limited_stream
+
 CHUNK_SIZE = 4000
 CHUNK_LENGTH_MS = 4*60*1000  # 4 minutes
 
 def convert_m4a_to_mp3(m4a_path, mp3_path):
-    audio = AudioSegment.from_file(m4a_path, "m4a")
-    audio.export(mp3_path, format="mp3")
+    from audio_preprocess import transcode_to_mp3
+
+    transcode_to_mp3(m4a_path, mp3_path)
+
+def chunk_audio(audio_path, out_dir=None, sample_rate=None):
+    # The recording (any format ffmpeg reads, e.g. m4a) is decoded one chunk at a time,
+    # so memory does not depend on its length. Chunks are written to out_dir, or to the
+    # current directory, as MP3 files; with sample_rate as mono at that rate. Returns
+    # (file name, offset of the chunk in the recording in ms) pairs.
+    from audio_preprocess import iter_pcm_windows, write_mp3
 
-def chunk_audio(mp3_path):
-    audio = AudioSegment.from_file(mp3_path, "mp3")
-    chunks = make_chunks(audio, CHUNK_LENGTH_MS)
     chunk_files = []
 
-    for i, chunk in enumerate(chunks):
-        chunk_name = f"{mp3_path.stem}_chunk{i}.mp3"
-        chunk.export(chunk_name, format="mp3")
-        chunk_files.append(chunk_name)
+    for window in iter_pcm_windows(audio_path, CHUNK_LENGTH_MS):
+        chunk_name = f"{Path(audio_path).stem}_chunk{window.index}.mp3"
+        if out_dir is not None:
+            chunk_name = os.path.join(out_dir, chunk_name)
+        write_mp3(window, chunk_name, sample_rate)
+        chunk_files.append((chunk_name, window.offset_ms))
 
     return chunk_files
 
-def read_audio(audio_file_name):
+def audio_format_options(sample_rate=None):
+    # MP3, sent as is or re-encoded to mono at the sample rate. Only audio with silence
+    # cut out is sent as LINEAR16 mono at sample_rate, as it is produced as raw samples.
+    if sample_rate is None:
+        return stt_pb2.AudioFormatOptions(
+            container_audio=stt_pb2.ContainerAudio(
+                container_audio_type=stt_pb2.ContainerAudio.MP3,
+            )
+        )
+    return stt_pb2.AudioFormatOptions(
+        raw_audio=stt_pb2.RawAudio(
+            audio_encoding=stt_pb2.RawAudio.LINEAR16_PCM,
+            sample_rate_hertz=sample_rate,
+            audio_channel_count=1,
+        )
+    )
+
+def read_audio(audio_file_name, sample_rate=None, trimmer=None):
     # Specify the recognition settings.
     recognize_options = stt_pb2.StreamingOptions(
         recognition_model=stt_pb2.RecognitionModelOptions(
-            audio_format=stt_pb2.AudioFormatOptions(
-                container_audio=stt_pb2.ContainerAudio(
-                    container_audio_type=stt_pb2.ContainerAudio.MP3,
-                )
-            ),
+            audio_format=audio_format_options(sample_rate if trimmer is not None else None),
 
             text_normalization=stt_pb2.TextNormalizationOptions(
                 text_normalization=stt_pb2.TextNormalizationOptions.TEXT_NORMALIZATION_ENABLED,
@@ -62,7 +83,22 @@ def read_audio(audio_file_name):
 
     # Send a message with recognition settings.
     yield stt_pb2.StreamingRequest(session_options=recognize_options)
-    
+
+    if trimmer is not None:
+        # Long pauses are cut out; the trimmer records where, to map timestamps back.
+        from silence_trim import iter_trimmed_chunks
+
+        for data in iter_trimmed_chunks(audio_file_name, trimmer):
+            yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
+        return
+
+    if sample_rate is not None:
+        from audio_preprocess import iter_mp3_file
+
+        for data in iter_mp3_file(audio_file_name, sample_rate):
+            yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
+        return
+
     # Read the audio file and send its contents in portions.
     with open(audio_file_name, "rb") as f:
         data = f.read(CHUNK_SIZE)
@@ -70,22 +106,40 @@ def read_audio(audio_file_name):
             yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
             data = f.read(CHUNK_SIZE)
 
-def recognize_audio(audio_file_name, out_file_name):
+def create_stub(options=None):
     # Establish a connection with the server.
     cred = grpc.ssl_channel_credentials()
-    channel = grpc.secure_channel("api.speechkit.cloudil.com:443", cred)
-    stub = stt_service_pb2_grpc.RecognizerStub(channel)
+    channel = grpc.secure_channel("api.speechkit.cloudil.com:443", cred, options=options)
+    return stt_service_pb2_grpc.RecognizerStub(channel)
+
+def recognize_audio(audio_file_name, out_file_name, stub=None, sample_rate=None, trim_silence=False,
+                    offset_ms=0, quiet=False):
+    # offset_ms is added to the times written, e.g. the position of a chunk in the recording.
+    # quiet=True only writes the file, for workers that recognize several files at once.
+    # Reuse the caller's connection if there is one, e.g. in a long-running worker.
+    if stub is None:
+        stub = create_stub()
+
+    trimmer = None
+    to_original = lambda ms: ms + offset_ms
+    if trim_silence:
+        # Imported here so that recognition without trimming does not need NumPy.
+        from silence_trim import SilenceTrimmer
+
+        sample_rate = sample_rate or 16000
+        trimmer = SilenceTrimmer(sample_rate)
+        to_original = lambda ms: trimmer.offset_map.to_original(ms) + offset_ms
 
     api_key = os.environ["SPEECHKIT_API_KEY"]
 
     # Send data for recognition.
-    it = stub.RecognizeStreaming(
-        read_audio(audio_file_name), metadata=(("authorization", f"Api-Key {api_key}"),)
-    )
+    it = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(
+        read_audio(audio_file_name, sample_rate, trimmer), metadata=(("authorization", f"Api-Key {api_key}"),)
+    ))
 
     # Process the server responses and output the result to the console and to the file.
     try:
-        with output(initial_len=1) as output_lines:
+        with contextlib.nullcontext() if quiet else output(initial_len=1) as output_lines:
             for r in it:
                 event_type, alternatives = r.WhichOneof("Event"), None
                 if event_type == "partial" and len(r.partial.alternatives) > 0:
@@ -96,21 +150,23 @@ def recognize_audio(audio_file_name, out_file_name):
                     with open(out_file_name, "a") as f:
                         for a in r.final.alternatives:
                             # Writing the phrase and its start and end times
-                            f.write(f"{a.text} {a.start_time_ms} {a.end_time_ms}\n")
+                            f.write(f"{a.text} {to_original(a.start_time_ms)} {to_original(a.end_time_ms)}\n")
                 elif event_type == "final_refinement":
                     alternatives = [a.text for a in r.final_refinement.normalized_text.alternatives]
-                    output_lines.append("")
+                    if output_lines is not None:
+                        output_lines.append("")
                     with open(out_file_name, "a") as f:
                         f.write(alternatives[0])
                 else:
                     continue
-                output_lines[-1] = alternatives[0]
+                if output_lines is not None:
+                    output_lines[-1] = alternatives[0]
 
     except grpc._channel._Rendezvous as err:
         print(f"Error code {err._state.code}, message: {err._state.details}")
         raise err
 
-def process_directory(input_dir, output_dir):
+def process_directory(input_dir, output_dir, sample_rate=None, trim_silence=False):
     input_dir_path = Path(input_dir)
     output_dir_path = Path(output_dir)
 
@@ -118,19 +174,21 @@ def process_directory(input_dir, output_dir):
         output_dir_path.mkdir()
 
     for audio_file in input_dir_path.glob("*.m4a"):
-        mp3_file = output_dir_path / (audio_file.stem + ".mp3")
         txt_file = output_dir_path / (audio_file.stem + ".txt")
-        
-        convert_m4a_to_mp3(audio_file, mp3_file)
 
-        chunk_files = chunk_audio(mp3_file)
+        # Chunks are cut straight from the recording and are already at sample_rate, so
+        # they are only decoded again to trim silence.
+        chunk_files = chunk_audio(audio_file, output_dir_path, sample_rate)
 
-        for chunk_file in chunk_files:
-            recognize_audio(chunk_file, txt_file)
+        for chunk_file, offset_ms in chunk_files:
+            recognize_audio(chunk_file, txt_file, sample_rate=sample_rate if trim_silence else None,
+                            trim_silence=trim_silence, offset_ms=offset_ms)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input_dir")
     parser.add_argument("output_dir")
+    parser.add_argument("--sample-rate", type=int, default=None, choices=[8000, 16000])
+    parser.add_argument("--trim-silence", action="store_true")
     args = parser.parse_args()
-    process_directory(args.input_dir, args.output_dir)
+    process_directory(args.input_dir, args.output_dir, args.sample_rate, args.trim_silence)
@@ -5,9 +5,10 @@ import grpc
 from reprint import output
 import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
 import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
-from pydub import AudioSegment
-from pydub.utils import make_chunks
 import glob
+
+from adaptive_concurrency import STT_LIMITER, limited_stream
+from audio_preprocess import iter_pcm_windows, write_mp3
 import moviepy.editor as mp
 
 CHUNK_SIZE = 4000
@@ -18,14 +19,13 @@ def extract_audio_from_mov(mov_path, mp3_path):
     clip.audio.write_audiofile(mp3_path)
 
 def chunk_audio(mp3_path):
-    audio = AudioSegment.from_file(mp3_path, "mp3")
-    chunks = make_chunks(audio, CHUNK_LENGTH_MS)
+    # Returns (file name, offset of the chunk in the recording in ms) pairs.
     chunk_files = []
 
-    for i, chunk in enumerate(chunks):
-        chunk_name = f"{mp3_path.stem}_chunk{i}.mp3"
-        chunk.export(chunk_name, format="mp3")
-        chunk_files.append(chunk_name)
+    for window in iter_pcm_windows(mp3_path, CHUNK_LENGTH_MS):
+        chunk_name = f"{mp3_path.stem}_chunk{window.index}.mp3"
+        write_mp3(window, chunk_name)
+        chunk_files.append((chunk_name, window.offset_ms))
 
     return chunk_files
 
@@ -64,16 +64,16 @@ def read_audio(audio_file_name):
             yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
             data = f.read(CHUNK_SIZE)
 
-def recognize_audio(audio_file_name, out_file_name):
+def recognize_audio(audio_file_name, out_file_name, offset_ms=0):
     cred = grpc.ssl_channel_credentials()
     channel = grpc.secure_channel("api.speechkit.cloudil.com:443", cred)
     stub = stt_service_pb2_grpc.RecognizerStub(channel)
 
     api_key = os.environ["SPEECHKIT_API_KEY"]
 
-    it = stub.RecognizeStreaming(
+    it = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(
         read_audio(audio_file_name), metadata=(("authorization", f"Api-Key {api_key}"),)
-    )
+    ))
 
     try:
         with output(initial_len=1) as output_lines:
@@ -85,7 +85,7 @@ def recognize_audio(audio_file_name, out_file_name):
                     alternatives = [a.text for a in r.final.alternatives]
                     with open(out_file_name, "a") as f:
                         for a in r.final.alternatives:
-                            f.write(f"{a.text} {a.start_time_ms} {a.end_time_ms}\n")
+                            f.write(f"{a.text} {a.start_time_ms + offset_ms} {a.end_time_ms + offset_ms}\n")
                 elif event_type == "final_refinement":
                     alternatives = [a.text for a in r.final_refinement.normalized_text.alternatives]
                     output_lines.append("")
@@ -114,8 +114,8 @@ def process_directory(input_dir, output_dir):
 
         chunk_files = chunk_audio(mp3_file)
 
-        for chunk_file in chunk_files:
-            recognize_audio(chunk_file, txt_file)
+        for chunk_file, offset_ms in chunk_files:
+            recognize_audio(chunk_file, txt_file, offset_ms)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -5,26 +5,27 @@ import grpc
 from reprint import output
 import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
 import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
-from pydub import AudioSegment
-from pydub.utils import make_chunks
 import glob
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from adaptive_concurrency import STT_LIMITER, limited_stream
+from audio_preprocess import iter_pcm_windows, write_mp3
+from recognition import recognize_file
 
 # Define the chunk size for reading the audio file
 CHUNK_SIZE = 4000
+# Length of the chunks recognized in one session
+CHUNK_LENGTH_MS = 4.5 * 60 * 1000  # 4.5 minutes in milliseconds
 
 # Function to convert and chunk audio from m4a to mp3 format
-def convert_and_chunk_audio(m4a_path, mp3_path):
-    # Load audio file
-    audio = AudioSegment.from_file(m4a_path, "m4a")
-
-    # Define chunk length in milliseconds
-    chunk_length_ms = 4.5 * 60 * 1000  # 4.5 minutes in milliseconds
-    chunks = make_chunks(audio, chunk_length_ms)  # Make chunks of 4.5 mins
-
-    # Export all of the individual chunks as .mp3 files
-    for i, chunk in enumerate(chunks):
-        chunk_name = f"{mp3_path.stem}_{i}.mp3"
-        chunk.export(chunk_name, format="mp3")
+def convert_and_chunk_audio(m4a_path, mp3_path, sample_rate=None):
+    # Decode the recording sequentially, holding one chunk of PCM audio in memory at a time
+    for window in iter_pcm_windows(m4a_path, CHUNK_LENGTH_MS):
+        # Export each chunk as an .mp3 file
+        chunk_name = f"{mp3_path.stem}_{window.index}.mp3"
+        write_mp3(window, chunk_name, sample_rate)  # Mono at sample_rate if one is given
         yield chunk_name
 
 # Function to read audio file and generate streaming requests for recognition
@@ -77,9 +78,9 @@ def recognize_audio(audio_file_name, out_file_name):
     api_key = os.environ["SPEECHKIT_API_KEY"]
 
     # Send data for recognition.
-    it = stub.RecognizeStreaming(
+    it = limited_stream(STT_LIMITER, lambda: stub.RecognizeStreaming(
         read_audio(audio_file_name), metadata=(("authorization", f"Api-Key {api_key}"),)
-    )
+    ))
 
     # Process the server responses and output the result to the console and to the file.
     try:
@@ -202,11 +203,121 @@ def merge_files(output_dir):
         for speaker, text in final_lines_per_file:
             f.write(f"{speaker}: {text}\n")
 
+class LiveMerger:
+    """
+    Merges finals from several speaker tracks into one transcript ordered by global
+    timestamp while the tracks are still being recognized.
+
+    Each track reports its finals in time order. A final is written once every
+    unfinished track has progressed past its start time, so lines never have to be
+    reordered after they are written.
+    """
+
+    def __init__(self, out_file, speakers):
+        self.out_file = out_file
+        self.lock = threading.Lock()
+        self.heap = []
+        # track -> speaker written for its finals. Tracks are keyed by file, so two
+        # files with the same speaker name are still tracked separately.
+        self.speakers = dict(speakers)
+        # track -> time (ms) up to which the track has been recognized
+        self.progress = {track: 0 for track in self.speakers}
+
+    def add(self, track, text, start_ms, end_ms):
+        with self.lock:
+            heapq.heappush(self.heap, (start_ms, end_ms, self.speakers[track], text))
+            self.progress[track] = max(self.progress[track], start_ms)
+            self._flush()
+
+    def advance(self, track, time_ms):
+        # Called when a track has been recognized up to time_ms without new finals.
+        with self.lock:
+            self.progress[track] = max(self.progress[track], time_ms)
+            self._flush()
+
+    def finish(self, track):
+        self.advance(track, float("inf"))
+
+    def _flush(self):
+        watermark = min(self.progress.values())
+        while self.heap and self.heap[0][0] <= watermark:
+            start_ms, end_ms, speaker, text = heapq.heappop(self.heap)
+            self.out_file.write(f"{speaker}: {text} {start_ms} {end_ms}\n")
+        self.out_file.flush()
+
+
+# Function to recognize one speaker track and feed its finals to the merger
+def recognize_track(audio_file, output_dir_path, merger, sample_rate=None, trim_silence=False):
+    mp3_file = output_dir_path / (audio_file.stem + ".mp3")
+    txt_file = output_dir_path / (audio_file.stem + ".txt")
+
+    try:
+        with open(txt_file, "a") as f:
+            for i, chunk_name in enumerate(convert_and_chunk_audio(audio_file, mp3_file, sample_rate)):
+                # Timestamps are relative to the chunk, shift them to the whole recording.
+                offset_ms = int(i * CHUNK_LENGTH_MS)
+                segments = recognize_file(
+                    chunk_name,
+                    language="he-IL",
+                    processing=stt_pb2.RecognitionModelOptions.FULL_DATA,
+                    max_pause_between_words_hint_ms=2500,
+                    # The chunk is already at sample_rate; only trimming decodes it again.
+                    sample_rate=sample_rate if trim_silence else None,
+                    trim_silence=trim_silence,
+                )
+                for segment in segments:
+                    start_ms, end_ms = segment.start_ms + offset_ms, segment.end_ms + offset_ms
+                    f.write(f"{segment.text} {start_ms} {end_ms}\n")
+                    merger.add(audio_file, segment.text, start_ms, end_ms)
+                merger.advance(audio_file, int((i + 1) * CHUNK_LENGTH_MS))
+    finally:
+        merger.finish(audio_file)
+
+
+# Function to recognize all speaker tracks concurrently with a live merged transcript
+def process_directory_parallel(input_dir, output_dir, max_workers=None, sample_rate=None, trim_silence=False):
+    input_dir_path = Path(input_dir)
+    output_dir_path = Path(output_dir)
+
+    if not output_dir_path.is_dir():
+        output_dir_path.mkdir()
+
+    audio_files = sorted(input_dir_path.glob("*.m4a"))
+    if not audio_files:
+        return
+
+    # A final is only written once every track has passed its start time, so a track
+    # that is still queued would hold back the whole transcript.
+    if max_workers is not None and max_workers < len(audio_files):
+        raise ValueError(f"{len(audio_files)} tracks need at least as many workers, got {max_workers}; "
+                         "use --sequential to recognize them one after another")
+    # All tracks are meant to be recognized at once, so do not ramp up from a lower limit.
+    workers = len(audio_files)
+    STT_LIMITER.seed(workers)
+
+    # The merged transcript grows while the tracks are recognized.
+    with open(output_dir_path / "merged.txt", "w") as out_file:
+        merger = LiveMerger(out_file, {f: get_speaker(f) for f in audio_files})
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(recognize_track, f, output_dir_path, merger, sample_rate, trim_silence) for f in audio_files]
+            for future in futures:
+                future.result()
+
 # Main script execution
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input_dir")  # Define command-line argument for input directory
     parser.add_argument("output_dir")  # Define command-line argument for output directory
+    parser.add_argument("--sequential", action="store_true")  # Recognize the speaker tracks one after another
+    parser.add_argument("--workers", type=int, default=None)  # Tracks recognized at the same time, at least the number of tracks
+    parser.add_argument("--sample-rate", type=int, default=None, choices=[8000, 16000])  # Re-encode to mono MP3 at this rate
+    parser.add_argument("--trim-silence", action="store_true")  # Cut long pauses out of the tracks before sending
     args = parser.parse_args()
-    process_directory(args.input_dir, args.output_dir)  # Process all audio files in the input directory
-    merge_files(args.output_dir)  # Merge all transcriptions into a single file
+    if args.sequential and (args.sample_rate or args.trim_silence or args.workers):
+        # The sequential path streams the chunks as they are.
+        parser.error("--sample-rate, --trim-silence and --workers cannot be used with --sequential")
+    if args.sequential:
+        process_directory(args.input_dir, args.output_dir)  # Process all audio files in the input directory
+        merge_files(args.output_dir)  # Merge all transcriptions into a single file
+    else:
+        process_directory_parallel(args.input_dir, args.output_dir, args.workers, args.sample_rate, args.trim_silence)
@@ -0,0 +1,215 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from adaptive_concurrency import STT_LIMITER, serve_metrics
+from transcribing_meeting_zoom import chunk_audio, create_stub, recognize_audio
+
+# Recordings picked up from the inbox.
+WATCHED_SUFFIXES = {".m4a", ".mp3"}
+# Seconds a file must keep the same size and mtime before it is considered complete.
+SETTLE_SECONDS = 5
+POLL_INTERVAL = 2
+
+# Keep the idle channel alive between recordings instead of reconnecting.
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+# inotify flags from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+INOTIFY_EVENT_SIZE = struct.calcsize("iIII")
+
+
+class InotifyWatcher:
+    """
+    Wakes up as soon as something changes in the directory (Linux only).
+    """
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        # We only use events as a wake-up signal and rescan the directory afterwards,
+        # so the event payloads are drained and discarded.
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self.fd, 64 * INOTIFY_EVENT_SIZE):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+def make_watcher(directory):
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError, TypeError):
+        print("inotify is not available, falling back to polling.")
+        return PollingWatcher()
+
+
+def move_atomic(src, dst):
+    # os.replace is atomic within a filesystem; across filesystems copy to a temporary
+    # name next to the destination first, then rename it into place.
+    try:
+        os.replace(src, dst)
+    except OSError:
+        tmp = Path(dst).with_name(f".{Path(dst).name}.tmp")
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+        os.remove(src)
+
+
+class FolderWorker:
+    """
+    Long-running worker: watches inbox_dir, waits until each recording stops growing,
+    transcribes it with a warm gRPC channel and a persistent thread pool, and moves
+    the transcript to output_dir and the recording to done_dir.
+    """
+
+    def __init__(self, inbox_dir, output_dir, done_dir, workers=2,
+                 settle_seconds=SETTLE_SECONDS, poll_interval=POLL_INTERVAL):
+        self.inbox_dir = Path(inbox_dir)
+        self.output_dir = Path(output_dir)
+        self.done_dir = Path(done_dir)
+        self.work_dir = self.output_dir / ".work"
+        self.failed_dir = self.inbox_dir / "failed"
+        for d in (self.output_dir, self.done_dir, self.work_dir, self.failed_dir):
+            d.mkdir(parents=True, exist_ok=True)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+
+        self.stub = create_stub(options=CHANNEL_OPTIONS)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        STT_LIMITER.seed(workers)
+        self.watcher = make_watcher(self.inbox_dir)
+        # path -> (size, mtime, time the pair was first seen)
+        self.pending = {}
+        self.in_progress = set()
+        self.lock = threading.Lock()
+
+    def _scan(self):
+        now = time.monotonic()
+        seen = set()
+        for path in self.inbox_dir.iterdir():
+            if path.suffix.lower() not in WATCHED_SUFFIXES or path.name.startswith("."):
+                continue
+            seen.add(path)
+            with self.lock:
+                if path in self.in_progress:
+                    continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            signature = (st.st_size, st.st_mtime)
+            previous = self.pending.get(path)
+            if previous is None or previous[:2] != signature:
+                self.pending[path] = signature + (now,)
+            elif st.st_size > 0 and now - previous[2] >= self.settle_seconds:
+                del self.pending[path]
+                with self.lock:
+                    self.in_progress.add(path)
+                self.pool.submit(self._process, path)
+        for path in set(self.pending) - seen:
+            del self.pending[path]
+
+    def _process(self, path):
+        started = time.monotonic()
+        # Work files are named after the whole file name, so a.m4a and a.mp3 in the inbox
+        # do not share them.
+        work_txt = self.work_dir / (path.name + ".txt")
+        chunk_dir = self.work_dir / (path.name + ".chunks")
+        try:
+            if work_txt.exists():
+                work_txt.unlink()
+            chunk_dir.mkdir(exist_ok=True)
+
+            # Chunks are cut straight from the recording, without an intermediate MP3.
+            for chunk_file, offset_ms in chunk_audio(path, chunk_dir):
+                try:
+                    recognize_audio(chunk_file, work_txt, stub=self.stub, offset_ms=offset_ms, quiet=True)
+                finally:
+                    os.remove(chunk_file)
+
+            # The transcript appears in the output directory only when it is complete. It
+            # keeps the extension of the recording, so a.m4a and a.mp3 get their own.
+            move_atomic(work_txt, self.output_dir / (path.name + ".txt"))
+            move_atomic(path, self.done_dir / path.name)
+            print(f"Processed {path.name} in {time.monotonic() - started:.1f} s")
+        except Exception as err:
+            # Park the recording so it is not picked up again on the next scan.
+            print(f"Failed to process {path.name}: {err}")
+            if path.exists():
+                move_atomic(path, self.failed_dir / path.name)
+        finally:
+            # Partial transcripts and chunks of a failed recording are not kept.
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+            if work_txt.exists():
+                work_txt.unlink()
+            with self.lock:
+                self.in_progress.discard(path)
+
+    def run_forever(self):
+        print(f"Watching {self.inbox_dir}...")
+        try:
+            while True:
+                self._scan()
+                # While files are settling, rescan often enough to notice they stopped growing.
+                timeout = min(self.poll_interval, self.settle_seconds) if self.pending else self.poll_interval
+                self.watcher.wait(timeout)
+        finally:
+            self.watcher.close()
+            self.pool.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inbox_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--done-dir", default=None)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--settle-seconds", type=float, default=SETTLE_SECONDS)
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    parser.add_argument("--metrics-port", type=int, default=None)  # Serve concurrency limits as JSON
+    args = parser.parse_args()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    done_dir = args.done_dir or Path(args.inbox_dir) / "done"
+    worker = FolderWorker(args.inbox_dir, args.output_dir, done_dir, args.workers,
+                          args.settle_seconds, args.poll_interval)
+    worker.run_forever()
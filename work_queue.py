@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import grpc
+
+import yandex.cloud.ai.stt.v3.stt_pb2 as stt_pb2
+import yandex.cloud.ai.stt.v3.stt_service_pb2_grpc as stt_service_pb2_grpc
+
+from audio_preprocess import iter_pcm_windows, write_mp3
+from recognition import create_stub, recognize_file
+
+# Length of the chunk tasks the coordinator cuts recordings into.
+CHUNK_LENGTH_MS = 4 * 60 * 1000
+# A worker that has not renewed its lease for this long is considered dead and its
+# task is handed to another worker.
+LEASE_SECONDS = 120
+# Tasks that failed this many times are not retried any more.
+MAX_ATTEMPTS = 3
+RECORDING_SUFFIXES = {".m4a", ".mp3", ".wav", ".mp4"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    recording TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    chunk_path TEXT NOT NULL,
+    offset_ms INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    UNIQUE (recording, chunk_index)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until);
+"""
+
+
+class TaskQueue:
+    """
+    Queue of chunk tasks in a SQLite file on storage shared by all nodes. A task is
+    claimed with a lease; a worker renews the lease while it works, and a task whose
+    lease ran out is claimed again by someone else. Results are only accepted from
+    the worker that holds the lease, so a worker that was presumed dead cannot
+    overwrite the result of the one that took over.
+    """
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.db_path = Path(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit mode: every write below runs in an explicit BEGIN IMMEDIATE, which
+        # takes the database lock up front so two workers never claim the same task.
+        # The default rollback journal is kept, as WAL does not work on network file systems.
+        self.conn = sqlite3.connect(str(self.db_path), timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript(SCHEMA)
+
+    def _write(self, sql, params=()):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            return cursor
+
+    def add_recording(self, recording, chunks):
+        """
+        Add the tasks of all chunks of a recording, given as (chunk_index, chunk_path,
+        offset_ms), in one transaction. A recording is either fully enqueued or not at
+        all, so assemble never sees part of it and a coordinator that crashed while
+        cutting it enqueues it again on the next run.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO tasks (recording, chunk_index, chunk_path, offset_ms)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(recording, index, path, offset_ms) for index, path, offset_ms in chunks],
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def claim(self, worker):
+        """
+        Lease the oldest pending or expired task to worker. Returns (id, chunk_path,
+        offset_ms) or None if there is nothing to do right now.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # A task that keeps killing its workers is given up instead of re-leased.
+                self.conn.execute(
+                    "UPDATE tasks SET state = 'failed', error = 'lease expired', worker = NULL"
+                    " WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                    (now, self.max_attempts),
+                )
+                row = self.conn.execute(
+                    "SELECT id, chunk_path, offset_ms FROM tasks"
+                    " WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)"
+                    " ORDER BY recording, chunk_index LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?,"
+                        " attempts = attempts + 1 WHERE id = ?",
+                        (worker, now + self.lease_seconds, row[0]),
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def renew(self, task_id, worker):
+        cursor = self._write(
+            "UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + self.lease_seconds, task_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, task_id, worker, result):
+        cursor = self._write(
+            "UPDATE tasks SET state = 'done', result = ?, lease_until = NULL"
+            " WHERE id = ? AND worker = ? AND state = 'leased'",
+            (json.dumps(result), task_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, task_id, worker, error):
+        # Give the task back, or give up on it after max_attempts.
+        self._write(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+            " error = ?, worker = NULL, lease_until = NULL"
+            " WHERE id = ? AND worker = ? AND state = 'leased'",
+            (self.max_attempts, error, task_id, worker),
+        )
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall()
+        return dict(rows)
+
+    def recordings(self):
+        """
+        Yield (recording, chunks_total, chunks_done, chunks_failed).
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT recording, COUNT(*), SUM(state = 'done'), SUM(state = 'failed')"
+                " FROM tasks GROUP BY recording ORDER BY recording"
+            ).fetchall()
+        return rows
+
+    def results(self, recording):
+        # Results of all chunks of a recording, in chunk order.
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT result FROM tasks WHERE recording = ? AND state = 'done' ORDER BY chunk_index",
+                (recording,),
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def enqueue_directory(input_dir, shared_dir, chunk_length_ms=CHUNK_LENGTH_MS):
+    """
+    Coordinator: cut every recording in input_dir into MP3 chunks under shared_dir and
+    add one task per chunk to shared_dir/queue.db. Recordings that were already
+    enqueued are skipped, so this can be run again when new recordings arrive.
+    """
+    shared_dir_path = Path(shared_dir)
+    chunks_dir = shared_dir_path / "chunks"
+    chunks_dir.mkdir(parents=True, exist_ok=True)
+    queue = TaskQueue(shared_dir_path / "queue.db")
+    known = {r[0] for r in queue.recordings()}
+
+    for audio_file in sorted(Path(input_dir).iterdir()):
+        if audio_file.suffix.lower() not in RECORDING_SUFFIXES or audio_file.stem in known:
+            continue
+        chunks = []
+        for window in iter_pcm_windows(audio_file, chunk_length_ms):
+            chunk_name = f"{audio_file.stem}_chunk{window.index}.mp3"
+            write_mp3(window, chunks_dir / chunk_name)
+            # Paths are stored relative to the queue, as nodes may mount it in different places.
+            chunks.append((window.index, f"chunks/{chunk_name}", int(window.offset_ms)))
+        # Tasks are only added once every chunk is written.
+        queue.add_recording(audio_file.stem, chunks)
+        print(f"Enqueued {audio_file.name}")
+    queue.close()
+
+
+def _keep_leased(queue, task_id, worker, stop):
+    # Renew the lease while the chunk is being recognized.
+    while not stop.wait(queue.lease_seconds / 3):
+        if not queue.renew(task_id, worker):
+            return
+
+
+def run_worker(shared_dir, worker=None, language="he-IL", target=None, exit_when_idle=False,
+               idle_sleep=5):
+    """
+    Worker: claim chunk tasks, recognize them and store the phrases, with timestamps
+    shifted to the whole recording, as the task result. Any number of workers can run
+    on any number of nodes that see shared_dir.
+    """
+    shared_dir_path = Path(shared_dir)
+    queue = TaskQueue(shared_dir_path / "queue.db")
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    if target:
+        stub = stt_service_pb2_grpc.RecognizerStub(grpc.insecure_channel(target))
+    else:
+        stub = create_stub()
+
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            if exit_when_idle and not queue.counts().get("leased"):
+                break
+            time.sleep(idle_sleep)
+            continue
+
+        task_id, chunk_path, offset_ms = task
+        stop = threading.Event()
+        keeper = threading.Thread(target=_keep_leased, args=(queue, task_id, worker, stop), daemon=True)
+        keeper.start()
+        try:
+            segments = recognize_file(
+                shared_dir_path / chunk_path,
+                language=language,
+                stub=stub,
+                processing=stt_pb2.RecognitionModelOptions.FULL_DATA,
+                max_pause_between_words_hint_ms=2500,
+            )
+            phrases = [[s.text, s.start_ms + offset_ms, s.end_ms + offset_ms] for s in segments]
+        except Exception as err:
+            # Give the task back instead of dying with the lease held.
+            stop.set()
+            queue.fail(task_id, worker, f"{type(err).__name__}: {err}")
+            continue
+        stop.set()
+        if queue.complete(task_id, worker, phrases):
+            print(f"{worker} recognized {chunk_path}")
+        else:
+            print(f"{worker} lost the lease on {chunk_path}, result dropped")
+    queue.close()
+
+
+def assemble(shared_dir, output_dir):
+    """
+    Coordinator: write <output_dir>/<recording>.txt in the "text start end" format of
+    transcribing_meeting_zoom.py for every recording whose chunks are all done.
+    Returns the recordings that are not finished yet.
+    """
+    output_dir_path = Path(output_dir)
+    if not output_dir_path.is_dir():
+        output_dir_path.mkdir()
+    queue = TaskQueue(Path(shared_dir) / "queue.db")
+    unfinished = []
+    for recording, total, done, failed in queue.recordings():
+        if done < total:
+            unfinished.append(recording)
+            if failed:
+                print(f"{recording}: {failed} of {total} chunks failed")
+            continue
+        txt_file = output_dir_path / (recording + ".txt")
+        tmp_file = txt_file.with_suffix(".txt.tmp")
+        with open(tmp_file, "w") as f:
+            for phrases in queue.results(recording):
+                for text, start_ms, end_ms in phrases:
+                    f.write(f"{text} {start_ms} {end_ms}\n")
+        os.replace(tmp_file, txt_file)
+    queue.close()
+    return unfinished
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = commands.add_parser("enqueue")  # Split recordings into chunk tasks
+    enqueue_parser.add_argument("input_dir")
+    enqueue_parser.add_argument("shared_dir")
+
+    work_parser = commands.add_parser("work")  # Recognize chunk tasks
+    work_parser.add_argument("shared_dir")
+    work_parser.add_argument("--language", default="he-IL")
+    work_parser.add_argument("--target", default=None)  # host:port of an unencrypted recognizer, for testing
+    work_parser.add_argument("--exit-when-idle", action="store_true")
+
+    assemble_parser = commands.add_parser("assemble")  # Write the transcripts of finished recordings
+    assemble_parser.add_argument("shared_dir")
+    assemble_parser.add_argument("output_dir")
+
+    status_parser = commands.add_parser("status")
+    status_parser.add_argument("shared_dir")
+
+    args = parser.parse_args()
+    if args.command == "enqueue":
+        enqueue_directory(args.input_dir, args.shared_dir)
+    elif args.command == "work":
+        run_worker(args.shared_dir, language=args.language, target=args.target,
+                   exit_when_idle=args.exit_when_idle)
+    elif args.command == "assemble":
+        unfinished = assemble(args.shared_dir, args.output_dir)
+        if unfinished:
+            print(f"Not finished yet: {', '.join(unfinished)}")
+    else:
+        queue = TaskQueue(Path(args.shared_dir) / "queue.db")
+        print(json.dumps(queue.counts()))
+        for recording, total, done, failed in queue.recordings():
+            print(f"{recording}: {done}/{total} done, {failed} failed")